@@ -0,0 +1,311 @@
+"""
+Headless batch processing of many scene zips, without the Streamlit UI.
+
+Examples:
+    python batch.py scenes/ --output stats.csv --workers 8
+    python batch.py manifest.txt --output stats.parquet
+    python batch.py scenes/ --aoi field.geojson --output field_stats.csv
+    python batch.py scenes/ --resolution 20 --indices NDVI EVI
+    python batch.py scenes/ --export-cog rasters/
+    python batch.py season/ --aoi field.geojson --field north-plot
+
+Every scene is processed by a worker process with the same functions the app
+uses and one row of per-index statistics is written per scene. Scenes are
+streamed block by block (compute_indices_windowed), so memory does not grow
+with the scene size; with --index-store whole indices are computed
+(load_bands_and_compute_indices, compute_indices) to be saved for the app. Rows are appended as
+scenes finish, so an interrupted run resumes where it stopped.
+"""
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import stream
+from stream import (
+    INDEX_SHORT_NAMES,
+    STATS_PERCENTILES,
+    TARGET_RESOLUTIONS,
+    IndexStore,
+    TimeSeriesStore,
+    analysis_key,
+    compute_indices,
+    compute_indices_windowed,
+    format_analysis_summary,
+    has_summary_indices,
+    load_bands_and_compute_indices,
+    parse_field_boundary,
+    write_indices_cog,
+    reduce_index_statistics,
+    scene_acquisition,
+    scene_digest,
+)
+
+# Statistics exported for every index
+STAT_NAMES = (["count", "mean", "std", "min", "max"]
+              + [f"p{percent}" for percent in STATS_PERCENTILES] + ["valid_fraction"])
+
+FIELDNAMES = (
+    ["scene", "scene_hash", "status", "error", "seconds", "height", "width", "bands", "valid_fraction"]
+    + [f"{name}_{stat}" for name in INDEX_SHORT_NAMES for stat in STAT_NAMES]
+    + ["summary", "export", "date", "tile"]
+)
+
+
+class _MessageCollector(logging.Handler):
+    """Keeps the messages reported while one scene is processed."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def find_scenes(source):
+    """
+    List scene zips from a directory (searched recursively) or a manifest file
+    with one zip path per line. Relative manifest paths are resolved against
+    the manifest's folder; blank lines and lines starting with # are skipped.
+    """
+    if os.path.isdir(source):
+        scenes = []
+        for root, _, files in os.walk(source):
+            scenes.extend(os.path.join(root, name) for name in files if name.lower().endswith(".zip"))
+        return sorted(scenes)
+
+    base = os.path.dirname(os.path.abspath(source))
+    scenes = []
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                scenes.append(line if os.path.isabs(line) else os.path.join(base, line))
+    return scenes
+
+
+# Index store, field boundary, resolution, indices, GeoTIFF folder, time-series store and field
+# of the worker process (None when not given)
+_index_store = None
+_boundary = None
+_resolution = None
+_names = None
+_export_dir = None
+_timeseries = None
+_field = None
+
+
+def _init_worker(read_workers, index_store_dir=None, boundary=None, resolution=None, names=None, export_dir=None,
+                 timeseries_db=None, field=None):
+    """Split the cores between processes instead of oversubscribing band reads."""
+    global _index_store, _boundary, _resolution, _names, _export_dir, _timeseries, _field
+    stream.BAND_READ_WORKERS = read_workers
+    logging.getLogger(stream.__name__).propagate = False
+    if index_store_dir:
+        _index_store = IndexStore(index_store_dir)
+    if field:
+        _timeseries, _field = TimeSeriesStore(timeseries_db), field
+    _boundary, _resolution, _names, _export_dir = boundary, resolution, names, export_dir
+
+
+def process_scene(path):
+    """Process one scene zip and return its statistics row."""
+    started = time.perf_counter()
+    collector = _MessageCollector()
+    stream.logger.addHandler(collector)
+    row = {"scene": path, "status": "error"}
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        row["scene_hash"] = scene_digest(data)
+        # Same store key as the app uses for this scene, field and resolution
+        store_key = analysis_key(row["scene_hash"], _boundary, _resolution)
+        if _names:
+            store_key = f"{store_key}-{'-'.join(_names)}"
+
+        export = None
+        if _export_dir:
+            name = os.path.splitext(os.path.basename(path))[0]
+            export = row["export"] = os.path.join(_export_dir, f"{name}_indices.tif")
+
+        stored = _index_store.load(store_key) if _index_store else None
+        if stored is not None and stored[1] is not None:
+            # Already computed by the app or an earlier batch run
+            indices, stats = stored
+            row["height"], row["width"] = next(iter(indices.values())).shape
+            if export:
+                write_indices_cog(indices, _index_store.profile(store_key), export, _names)
+        elif _index_store is None:
+            # Without a store to fill, no index needs to be held whole: stream the scene block by block
+            stats = compute_indices_windowed(path, names=_names, boundary=_boundary, resolution=_resolution,
+                                             cog_path=export)
+            row["height"], row["width"] = stats.pop("height"), stats.pop("width")
+            row["bands"] = " ".join(stats.pop("bands"))
+        else:
+            bands = load_bands_and_compute_indices(data, _boundary, resolution=_resolution, names=_names)
+            if bands is None:
+                raise ValueError("; ".join(collector.messages) or "Could not load bands")
+            row["height"], row["width"] = bands.shape
+            row["bands"] = " ".join(bands)
+
+            indices = dict(zip(INDEX_SHORT_NAMES, compute_indices(bands, _names)))
+            region, profile = bands.region, bands.profile
+            del bands
+            stats = reduce_index_statistics(indices, region=region)
+            _index_store.save(store_key, indices, stats, profile, region)
+            if export:
+                write_indices_cog(indices, profile, export, _names)
+            del indices
+        row["valid_fraction"] = stats["valid_fraction"]
+        for name, index_stats in stats["indices"].items():
+            for stat in STAT_NAMES:
+                row[f"{name}_{stat}"] = index_stats[stat]
+
+        # Scenes limited with --indices lack what the summary is written from
+        if has_summary_indices(stats):
+            row["summary"] = format_analysis_summary(stats).strip()
+        if _timeseries:
+            row["date"], row["tile"] = scene_acquisition(data)
+            if row["date"] is None:
+                raise ValueError("No acquisition date in the band file names")
+            # The plain scene key, as the app records it, so the app knows the scene was recorded
+            scene_key = analysis_key(row["scene_hash"], _boundary, _resolution)
+            _timeseries.record(_field, row["date"], row["tile"], scene_key, stats)
+        row["status"] = "ok"
+    except Exception as e:
+        row["error"] = str(e)
+    finally:
+        stream.logger.removeHandler(collector)
+        row["seconds"] = round(time.perf_counter() - started, 3)
+    return row
+
+
+def journal_path(output):
+    """CSV file rows are appended to; Parquet outputs are converted from it at the end."""
+    return output if output.lower().endswith(".csv") else f"{output}.journal.csv"
+
+
+def completed_scenes(journal):
+    """Scenes already processed successfully by an earlier run."""
+    if not os.path.exists(journal):
+        return set()
+    with open(journal, newline="", encoding="utf-8") as f:
+        return {row["scene"] for row in csv.DictReader(f) if row.get("status") == "ok"}
+
+
+def write_parquet(journal, output):
+    """Convert the CSV journal into a Parquet file (needs pandas and pyarrow)."""
+    try:
+        import pandas as pd
+        frame = pd.read_csv(journal)
+        # Keep the latest row per scene so retried failures do not appear twice
+        frame.drop_duplicates(subset="scene", keep="last").to_parquet(output, index=False)
+    except ImportError as e:
+        raise SystemExit(f"Writing Parquet requires pandas and pyarrow ({e}); "
+                         f"the results are in {journal}")
+
+
+def run_batch(scenes, output, workers=None, resume=True, index_store_dir=None, boundary=None,
+              resolution=None, names=None, export_dir=None, field=None, timeseries_db=stream.TIMESERIES_DB,
+              log=sys.stderr):
+    """
+    Process scenes on a process pool and append one row per scene to the output.
+    boundary (see stream.parse_field_boundary) limits every scene to one field,
+    resolution resamples the bands to that many metres per pixel, names
+    limits the computed indices (and so the bands read) and export_dir gets
+    one cloud-optimized GeoTIFF of the indices per scene. With field, every
+    scene's statistics are also recorded under its acquisition date in the
+    time-series store at timeseries_db, where the app charts them.
+    Returns the number of scenes that failed.
+    """
+    journal = journal_path(output)
+    if not resume and os.path.exists(journal):
+        os.remove(journal)
+    done = completed_scenes(journal)
+    pending = [scene for scene in scenes if scene not in done]
+    if done:
+        print(f"Resuming: {len(scenes) - len(pending)} of {len(scenes)} scenes already done", file=log)
+
+    if export_dir:
+        os.makedirs(export_dir, exist_ok=True)
+    if field:
+        TimeSeriesStore(timeseries_db)  # create the tables once, before the workers share the database
+    workers = workers or os.cpu_count() or 1
+    read_workers = max(1, (os.cpu_count() or 1) // workers)
+    failures = 0
+    started = time.perf_counter()
+
+    new_file = not os.path.exists(journal) or os.path.getsize(journal) == 0
+    with open(journal, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES, extrasaction="ignore")
+        if new_file:
+            writer.writeheader()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(read_workers, index_store_dir, boundary, resolution, names,
+                                           export_dir, timeseries_db, field)) as pool:
+            futures = {pool.submit(process_scene, scene): scene for scene in pending}
+            for finished, future in enumerate(as_completed(futures), start=1):
+                row = future.result()
+                writer.writerow(row)
+                f.flush()
+
+                failures += row["status"] != "ok"
+                elapsed = time.perf_counter() - started
+                remaining = elapsed / finished * (len(pending) - finished)
+                message = row["status"] if row["status"] == "ok" else f"error: {row.get('error')}"
+                print(f"[{finished}/{len(pending)}] {os.path.basename(row['scene'])} {message} "
+                      f"({row['seconds']:.1f}s, ETA {remaining:.0f}s)", file=log)
+
+    if journal != output:
+        write_parquet(journal, output)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute index statistics for many satellite scene zips.")
+    parser.add_argument("source", help="Folder of scene zips, or a manifest file listing one zip per line")
+    parser.add_argument("-o", "--output", default="scene_stats.csv", help="Output .csv or .parquet file")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--no-resume", action="store_true", help="Reprocess scenes already in the output")
+    parser.add_argument("--index-store", metavar="DIR",
+                        help="Share computed index rasters with the app through this store "
+                             f"(the app uses {stream.INDEX_STORE_DIR})")
+    parser.add_argument("--aoi", metavar="GEOJSON", help="Only analyse the pixels inside this field boundary (WGS84)")
+    parser.add_argument("--resolution", type=int, choices=TARGET_RESOLUTIONS,
+                        help="Resample all bands to this many metres per pixel (default: finest band)")
+    parser.add_argument("--indices", nargs="+", choices=INDEX_SHORT_NAMES, metavar="INDEX",
+                        help="Only compute these indices, reading just the bands they need")
+    parser.add_argument("--export-cog", metavar="DIR",
+                        help="Also write each scene's indices as a cloud-optimized GeoTIFF into this folder")
+    parser.add_argument("--field", metavar="NAME",
+                        help="Record every scene's statistics by acquisition date under this field name "
+                             f"in the time-series store ({stream.TIMESERIES_DB})")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(message)s")
+    scenes = find_scenes(args.source)
+    if not scenes:
+        parser.error(f"No scene zips found in {args.source}")
+    boundary = None
+    if args.aoi:
+        try:
+            with open(args.aoi, encoding="utf-8") as f:
+                boundary = parse_field_boundary(geojson=f.read())
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            parser.error(f"Could not read the field boundary {args.aoi}: {e}")
+
+    failures = run_batch(scenes, args.output, workers=args.workers, resume=not args.no_resume,
+                         index_store_dir=args.index_store, boundary=boundary,
+                         resolution=args.resolution, names=args.indices, export_dir=args.export_cog,
+                         field=args.field)
+    print(f"Processed {len(scenes)} scenes, {failures} failed. Results in {args.output}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
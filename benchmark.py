@@ -0,0 +1,309 @@
+"""
+Reproducible performance benchmarks on synthetic Sentinel-2 scenes.
+
+Examples:
+    python benchmark.py                                  # field and farm sized scenes
+    python benchmark.py --sizes field tile --repeat 3 --output after.json
+    python benchmark.py --compare before.json --output after.json
+    python benchmark.py --stages startup --repeat 5        # cold import time only
+
+Synthetic scene zips (float32 GeoTIFF bands with configurable NaN and nodata
+fractions) are generated once into --data-dir and reused. Every pipeline stage
+is timed separately with its wall time and peak RSS, and the results are
+written as JSON so two runs can be compared to catch regressions. The startup
+stage times `import stream` in a fresh interpreter, which is what a new app
+worker pays before the first page renders.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+import stream
+from stream import (
+    INDEX_SHORT_NAMES,
+    PeakRSSSampler,
+    compute_indices,
+    format_analysis_summary,
+    load_bands_and_compute_indices,
+    open_scene,
+    reduce_index_statistics,
+    render_index_png,
+    scene_digest,
+)
+
+# Scene sizes in pixels per side; "tile" is a full 10980 x 10980 Sentinel-2 tile
+SCENE_SIZES = {"field": 512, "farm": 2048, "quarter": 5490, "tile": 10980}
+
+BENCHMARK_BANDS = ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B11", "B12"]
+
+STAGES = ["startup", "ingest", "load", "indices", "stats", "render", "end_to_end"]
+
+# Dependencies the app should only import once a scene is analysed
+HEAVY_MODULES = ["rasterio", "matplotlib", "groq"]
+
+# Run in a fresh interpreter: import time, peak RSS and heavy modules loaded by `import stream`
+_STARTUP_PROBE = f"""
+import json, sys, time
+started = time.perf_counter()
+import stream
+seconds = time.perf_counter() - started
+try:
+    import resource
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+except ImportError:
+    peak_rss = None
+print(json.dumps({{"seconds": seconds, "peak_rss": peak_rss,
+                  "heavy": [name for name in {HEAVY_MODULES!r} if name in sys.modules]}}))
+"""
+
+# Typical surface reflectance per band (bare soil to dense crop), used to shape the data
+_BAND_REFLECTANCE = {"B01": 0.05, "B02": 0.06, "B03": 0.09, "B04": 0.07, "B05": 0.14, "B06": 0.25,
+                     "B07": 0.30, "B08": 0.33, "B8A": 0.34, "B11": 0.22, "B12": 0.14}
+
+
+def _band_strip(band, rows, width, rng):
+    """Smooth field-like reflectance pattern with sensor noise for one strip of rows."""
+    y = rows[:, None] / 97.0
+    x = np.arange(width)[None, :] / 131.0
+    pattern = 0.5 + 0.25 * np.sin(x) * np.cos(y) + 0.25 * np.sin(0.37 * x + 0.23 * y)
+    noise = rng.normal(0.0, 0.02, (rows.size, width))
+    return (_BAND_REFLECTANCE[band] * (0.4 + pattern) + noise).astype(np.float32)
+
+
+def make_synthetic_scene(path, size, nan_fraction=0.0, nodata_fraction=0.0, seed=0, nodata=0.0):
+    """
+    Write a zip of single-band float32 GeoTIFFs named like Copernicus Browser exports.
+    Bands are generated strip by strip, so even a full tile needs little memory.
+    """
+    rng = np.random.default_rng(seed)
+    strip_rows = max(1, (1 << 22) // size)
+    transform = from_origin(77.0, 11.0, 0.0001, 0.0001)
+    profile = {"driver": "GTiff", "height": size, "width": size, "count": 1, "dtype": "float32",
+               "crs": "EPSG:4326", "transform": transform, "nodata": nodata}
+
+    tmp_path = f"{path}.tmp"
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zip_ref:
+        for band in BENCHMARK_BANDS:
+            band_path = os.path.join(tmp_dir, f"2025-02-26-00_00_2025-02-26-23_59_Sentinel-2_L2A_{band}_(Raw).tiff")
+            with rio.open(band_path, "w", **profile) as dst:
+                for row in range(0, size, strip_rows):
+                    rows = np.arange(row, min(row + strip_rows, size))
+                    data = _band_strip(band, rows, size, rng)
+                    data[rng.random(data.shape) < nan_fraction] = np.nan
+                    data[rng.random(data.shape) < nodata_fraction] = nodata
+                    dst.write(data, 1, window=Window(0, row, size, rows.size))
+            zip_ref.write(band_path, os.path.basename(band_path))
+            os.remove(band_path)
+    os.replace(tmp_path, path)
+
+
+def scene_path(data_dir, name, size, nan_fraction, nodata_fraction, seed):
+    """Cached synthetic scene for these parameters, generated on first use."""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"{name}_{size}_nan{nan_fraction:g}_nodata{nodata_fraction:g}_seed{seed}.zip")
+    if not os.path.exists(path):
+        print(f"Generating {os.path.basename(path)}...", file=sys.stderr)
+        make_synthetic_scene(path, size, nan_fraction, nodata_fraction, seed)
+    return path
+
+
+def measure(function, repeat):
+    """Run function repeat times; returns (last result, wall times, peak RSS, RSS growth)."""
+    walls, peak, growth, result = [], 0, 0, None
+    for _ in range(repeat):
+        result = None
+        gc.collect()
+        with PeakRSSSampler() as sampler:
+            started = time.perf_counter()
+            result = function()
+            walls.append(time.perf_counter() - started)
+        if sampler.peak_rss is not None:
+            peak = max(peak, sampler.peak_rss)
+            growth = max(growth, sampler.peak_rss - sampler.start_rss)
+    return result, walls, peak, growth
+
+
+def _ingest(path):
+    """Read the zip, hash it and open every band header."""
+    with open(path, "rb") as f:
+        data = f.read()
+    scene_digest(data)
+    with open_scene(data) as (band_files, open_band):
+        for band_file in band_files:
+            with open_band(band_file) as src:
+                src.profile
+    return data
+
+
+def _end_to_end(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    bands = load_bands_and_compute_indices(data)
+    indices = dict(zip(INDEX_SHORT_NAMES, compute_indices(bands)))
+    format_analysis_summary(reduce_index_statistics(indices))
+    render_index_png(indices["NDVI"])
+
+
+def benchmark_scene(path, repeat, stages):
+    """Time each stage on one scene, feeding every stage the previous one's output."""
+    timings = {}
+
+    def run(stage, function):
+        if stage not in stages:
+            return function() if stage != "end_to_end" else None
+        result, walls, peak, growth = measure(function, repeat)
+        timings[stage] = {
+            "wall_seconds": walls,
+            "wall_min": min(walls),
+            "wall_median": statistics.median(walls),
+            "peak_rss_bytes": peak,
+            "rss_growth_bytes": growth,
+        }
+        print(f"  {stage:<11} {min(walls):8.3f}s  peak RSS {peak / 1024 ** 2:8.0f} MB", file=sys.stderr)
+        return result
+
+    data = run("ingest", lambda: _ingest(path))
+    bands = run("load", lambda: load_bands_and_compute_indices(data))
+    indices = run("indices", lambda: dict(zip(INDEX_SHORT_NAMES, compute_indices(bands))))
+    del bands
+    run("stats", lambda: format_analysis_summary(reduce_index_statistics(indices)))
+    run("render", lambda: render_index_png(indices["NDVI"]))
+    del indices, data
+    run("end_to_end", lambda: _end_to_end(path))
+    return timings
+
+
+def benchmark_startup(repeat):
+    """Time `import stream` in a new Python process, repeat times."""
+    walls, peak, heavy = [], 0, []
+    for _ in range(repeat):
+        probe = subprocess.run([sys.executable, "-c", _STARTUP_PROBE], capture_output=True, text=True, check=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        result = json.loads(probe.stdout.strip().splitlines()[-1])
+        walls.append(result["seconds"])
+        peak, heavy = max(peak, result["peak_rss"] or 0), result["heavy"]
+    print(f"  {'startup':<11} {min(walls):8.3f}s  peak RSS {peak / 1024 ** 2:8.0f} MB"
+          f"{'  imports ' + ', '.join(heavy) if heavy else ''}", file=sys.stderr)
+    return {
+        "wall_seconds": walls,
+        "wall_min": min(walls),
+        "wall_median": statistics.median(walls),
+        "peak_rss_bytes": peak,
+        "rss_growth_bytes": peak,
+        "heavy_modules": heavy,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, repeat=1, nan_fraction=0.0, nodata_fraction=0.0, seed=0,
+                   data_dir=".bench_data", stages=STAGES):
+    """Benchmark every scene size; returns the JSON-serialisable report."""
+    results = []
+    if "startup" in stages:
+        print("startup (import stream in a new process)", file=sys.stderr)
+        results.append({"scene": "startup", "height": 0, "width": 0, "bands": 0, "nan_fraction": 0.0,
+                        "nodata_fraction": 0.0, "stage": "startup", "repeat": repeat, **benchmark_startup(repeat)})
+        stages = [stage for stage in stages if stage != "startup"]
+    for name in sizes if stages else []:
+        size = SCENE_SIZES[name]
+        path = scene_path(data_dir, name, size, nan_fraction, nodata_fraction, seed)
+        print(f"{name} ({size} x {size}, {len(BENCHMARK_BANDS)} bands)", file=sys.stderr)
+        for stage, timing in benchmark_scene(path, repeat, stages).items():
+            results.append({
+                "scene": name, "height": size, "width": size, "bands": len(BENCHMARK_BANDS),
+                "nan_fraction": nan_fraction, "nodata_fraction": nodata_fraction,
+                "stage": stage, "repeat": repeat, **timing,
+            })
+    return {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "rasterio": rio.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "read_workers": stream.BAND_READ_WORKERS,
+        },
+        "results": results,
+    }
+
+
+def compare_reports(baseline, current, tolerance):
+    """
+    Print the change of each (scene, stage) against a baseline report.
+    Returns the regressions: wall time or peak RSS worse by more than tolerance.
+    """
+    previous = {(row["scene"], row["stage"]): row for row in baseline["results"]}
+    regressions = []
+    print(f"{'scene':<8} {'stage':<11} {'wall':>18} {'peak RSS':>22}")
+    for row in current["results"]:
+        before = previous.get((row["scene"], row["stage"]))
+        if before is None:
+            continue
+        wall_ratio = row["wall_min"] / before["wall_min"] if before["wall_min"] else 1.0
+        rss_ratio = row["peak_rss_bytes"] / before["peak_rss_bytes"] if before["peak_rss_bytes"] else 1.0
+        flag = ""
+        if wall_ratio > 1 + tolerance or rss_ratio > 1 + tolerance:
+            regressions.append((row["scene"], row["stage"], wall_ratio, rss_ratio))
+            flag = "  REGRESSION"
+        print(f"{row['scene']:<8} {row['stage']:<11} "
+              f"{before['wall_min']:7.3f}s -> {row['wall_min']:7.3f}s "
+              f"{before['peak_rss_bytes'] / 1024 ** 2:8.0f} -> {row['peak_rss_bytes'] / 1024 ** 2:6.0f} MB{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the satellite analysis pipeline on synthetic scenes.")
+    parser.add_argument("--sizes", nargs="+", choices=list(SCENE_SIZES), default=["field", "farm"],
+                        help="Scene sizes to benchmark")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to time")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per stage (the minimum is compared)")
+    parser.add_argument("--nan-fraction", type=float, default=0.01, help="Fraction of NaN pixels per band")
+    parser.add_argument("--nodata-fraction", type=float, default=0.0, help="Fraction of nodata (0) pixels per band")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=".bench_data", help="Where synthetic scenes are cached")
+    parser.add_argument("-o", "--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="Baseline JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown/growth before flagging")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.sizes, args.repeat, args.nan_fraction, args.nodata_fraction,
+                            args.seed, args.data_dir, args.stages)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare_reports(json.load(f), report, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,224 +1,2023 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import zipfile
 import os
 from glob import glob
+from fnmatch import fnmatchcase
 import numpy as np
-import earthpy.spatial as es
-import rasterio as rio
 from datetime import datetime
-from groq import Groq
-import matplotlib.pyplot as plt
-import earthpy.plot as ep
 import warnings
 import base64
-from io import BytesIO
+import hashlib
+import threading
+import uuid
+import shutil
+import tempfile
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import time
+import json
+import csv
+import sqlite3
+import re
+from concurrent.futures import ThreadPoolExecutor
+import ast
+from functools import lru_cache
+from collections import OrderedDict, deque
+from contextlib import ExitStack, closing, contextmanager
+from io import BytesIO, StringIO
 warnings.filterwarnings('ignore')
 import os
 from dotenv import load_dotenv
 
+# rasterio, matplotlib and groq take most of the start-up time, so they are
+# imported inside the functions that use them: the upload page renders before
+# any of them is loaded, and Streamlit reruns find them in sys.modules.
+
 load_dotenv()
 
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+
+logger = logging.getLogger(__name__)
+
+# Memory budget (bytes) for scene results kept between Streamlit reruns
+RESULT_CACHE_BYTES = int(os.getenv("AGRISAT_CACHE_BYTES", 2 * 1024 ** 3))
+
+
+def report(level, message):
+    """
+    Show an error or warning on the page when running inside Streamlit,
+    and log it otherwise (batch jobs, benchmarks, background threads).
+    """
+    if get_script_run_ctx(suppress_warning=True) is None:
+        logger.log(logging.ERROR if level == "error" else logging.WARNING, message)
+    else:
+        getattr(st, level)(message)
+
+
+def _entry_nbytes(value):
+    """Estimate the memory held by a cached value (arrays, strings and containers)."""
+    if isinstance(value, np.memmap):
+        # Backed by a file in the page cache, shared with other sessions
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, dict):
+        return sum(_entry_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_entry_nbytes(v) for v in value)
+    return 0
+
+
+class ResultCache:
+    """
+    Least-recently-used cache of per-scene results bounded by a memory budget in bytes.
+    Entries are evicted oldest-first until the cached arrays fit the budget.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key (marking it recently used) or None."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, value):
+        """Store value under key, evicting least recently used entries to stay in budget."""
+        size = _entry_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._sizes.pop(key)
+                del self._entries[key]
+            if size > self.max_bytes:
+                # Larger than the whole budget; caching it would flush everything else
+                return False
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                old_key, _ = self._entries.popitem(last=False)
+                self._total_bytes -= self._sizes.pop(old_key)
+            return True
+
+    def clear(self):
+        """Drop every cached entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return hit/miss counters and current memory usage."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+@st.cache_resource
+def get_result_cache():
+    """Process-wide result cache shared by every rerun and session."""
+    return ResultCache(RESULT_CACHE_BYTES)
+
+
+def scene_digest(data):
+    """Content hash of an uploaded scene zip, used as the result cache key."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def uploaded_scene_digest(uploaded_file):
+    """Hash an upload once per session; reruns reuse the stored digest."""
+    digests = st.session_state.setdefault("scene_digests", {})
+    file_key = getattr(uploaded_file, "file_id", None) or (uploaded_file.name, uploaded_file.size)
+    if file_key not in digests:
+        digests[file_key] = scene_digest(uploaded_file.getvalue())
+    return digests[file_key]
+
+# Stage instrumentation (wall time, bytes read, peak memory) is off unless enabled
+INSTRUMENTATION_ENABLED = os.getenv("AGRISAT_INSTRUMENT", "").lower() in ("1", "true", "yes", "on")
+# Optional JSON-lines file receiving one record per stage run
+METRICS_LOG_PATH = os.getenv("AGRISAT_METRICS_LOG")
+# Optional port serving the metrics in Prometheus text format at /metrics
+METRICS_PORT = os.getenv("AGRISAT_METRICS_PORT")
+
+
+def current_rss():
+    """Resident set size of this process in bytes (Linux), or None elsewhere."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class PeakRSSSampler:
+    """
+    Samples RSS on a background thread and reports the peak seen during a block
+    (peak_rss is None where the platform offers no way to measure it).
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start_rss = self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, current_rss() or 0)
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = current_rss() or 0
+        if self.start_rss:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.peak_rss = max(self.peak_rss, current_rss() or 0)
+        else:
+            # No /proc: fall back to the process-wide high-water mark (KiB on Linux, bytes on macOS);
+            # unknown (None) where the resource module does not exist, i.e. on Windows
+            try:
+                import resource
+            except ImportError:
+                self.peak_rss = None
+            else:
+                maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                self.peak_rss = maxrss if sys.platform == "darwin" else maxrss * 1024
+        return False
+
+
+class _DisabledStage:
+    """Shared stand-in used while instrumentation is off; every method is a no-op."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_bytes(self, count):
+        pass
+
+
+_DISABLED_STAGE = _DisabledStage()
+
+
+class StageTimer:
+    """Measures one run of a pipeline stage and hands the record to its Instrumentation."""
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.bytes_read = 0
+
+    def add_bytes(self, count):
+        """Count bytes read by this stage."""
+        self.bytes_read += int(count)
+
+    def __enter__(self):
+        self._sampler = PeakRSSSampler().__enter__()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._started
+        self._sampler.__exit__(exc_type, exc, tb)
+        self.instrumentation.record({
+            "time": datetime.now().isoformat(timespec="milliseconds"),
+            "stage": self.name,
+            "seconds": round(wall, 6),
+            "bytes_read": self.bytes_read,
+            "peak_rss_bytes": self._sampler.peak_rss,
+            "rss_growth_bytes": (None if self._sampler.peak_rss is None
+                                 else self._sampler.peak_rss - self._sampler.start_rss),
+            "ok": exc_type is None,
+        })
+        return False
+
+
+class Instrumentation:
+    """
+    Collects per-stage records: keeps recent ones for the UI, running totals for
+    Prometheus, and optionally appends each record as a JSON line to a log file.
+    """
+
+    def __init__(self, enabled=False, log_path=None, history=200):
+        self.enabled = enabled
+        self.log_path = log_path
+        self.recent = deque(maxlen=history)
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """Context manager measuring one stage run (a shared no-op when disabled)."""
+        return StageTimer(self, name) if self.enabled else _DISABLED_STAGE
+
+    def record(self, entry):
+        with self._lock:
+            self.recent.append(entry)
+            totals = self.totals.setdefault(entry["stage"], {
+                "calls": 0, "errors": 0, "seconds": 0.0, "bytes_read": 0,
+                "last_seconds": 0.0, "peak_rss_bytes": 0,
+            })
+            totals["calls"] += 1
+            totals["errors"] += not entry["ok"]
+            totals["seconds"] += entry["seconds"]
+            totals["bytes_read"] += entry["bytes_read"]
+            totals["last_seconds"] = entry["seconds"]
+            totals["peak_rss_bytes"] = max(totals["peak_rss_bytes"], entry["peak_rss_bytes"] or 0)
+            if self.log_path:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+
+    def snapshot(self):
+        """Copies of the recent records and per-stage totals."""
+        with self._lock:
+            return list(self.recent), {stage: dict(totals) for stage, totals in self.totals.items()}
+
+    def prometheus_text(self):
+        """Per-stage totals in the Prometheus text exposition format."""
+        _, totals = self.snapshot()
+        metrics = [
+            ("agrisat_stage_calls_total", "counter", "Stage runs", "calls"),
+            ("agrisat_stage_errors_total", "counter", "Stage runs that raised", "errors"),
+            ("agrisat_stage_seconds_total", "counter", "Wall time spent in the stage", "seconds"),
+            ("agrisat_stage_bytes_read_total", "counter", "Bytes read by the stage", "bytes_read"),
+            ("agrisat_stage_last_seconds", "gauge", "Wall time of the latest run", "last_seconds"),
+            ("agrisat_stage_peak_rss_bytes", "gauge", "Highest RSS seen during the stage", "peak_rss_bytes"),
+        ]
+        lines = []
+        for metric, kind, help_text, field in metrics:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for stage, values in sorted(totals.items()):
+                lines.append(f'{metric}{{stage="{stage}"}} {values[field]}')
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(instrumentation, port):
+    """Serve instrumentation.prometheus_text() at /metrics on a daemon thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            body = instrumentation.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@st.cache_resource
+def get_instrumentation():
+    """Process-wide instrumentation, configured from the environment."""
+    instrumentation = Instrumentation(INSTRUMENTATION_ENABLED, METRICS_LOG_PATH)
+    if INSTRUMENTATION_ENABLED and METRICS_PORT:
+        start_metrics_server(instrumentation, int(METRICS_PORT))
+    return instrumentation
+
+
+def instrument_stage(name):
+    """Time one pipeline stage: with instrument_stage("band_io") as stage: ..."""
+    if not INSTRUMENTATION_ENABLED:
+        return _DISABLED_STAGE
+    return get_instrumentation().stage(name)
+
+
+def show_instrumentation_panel():
+    """Collapsible sidebar panel with recent stage timings and a Prometheus export."""
+    if not INSTRUMENTATION_ENABLED:
+        return
+    instrumentation = get_instrumentation()
+    recent, totals = instrumentation.snapshot()
+    with st.sidebar.expander("Performance metrics"):
+        if not recent:
+            st.caption("No stages recorded yet.")
+            return
+        st.dataframe(
+            [{"stage": entry["stage"], "seconds": entry["seconds"],
+              "MB read": round(entry["bytes_read"] / 1024 ** 2, 1),
+              "peak RSS MB": round(entry["peak_rss_bytes"] / 1024 ** 2) if entry["peak_rss_bytes"] else None}
+             for entry in reversed(recent)][:20],
+            hide_index=True,
+        )
+        st.dataframe(
+            [{"stage": stage, "calls": values["calls"], "total seconds": round(values["seconds"], 3)}
+             for stage, values in sorted(totals.items())],
+            hide_index=True,
+        )
+        st.download_button("Download Prometheus metrics", instrumentation.prometheus_text(),
+                           file_name="agrisat_metrics.prom", mime="text/plain")
+
+
+# Band rasters inside an upload, matched against the file name
+BAND_FILE_PATTERN = "*B?*.tiff"
+
+# Scene classification (SCL) rasters of Sentinel-2 L2A products
+SCL_FILE_PATTERNS = ("*SCL*.tiff", "*[Ss]cene_classification*.tiff")
+
+# SCL classes masked out: no data, saturated or defective, cloud shadow,
+# cloud medium and high probability, thin cirrus
+SCL_INVALID_CLASSES = (0, 1, 3, 8, 9, 10)
+
+
+def list_band_members(names):
+    """Pick the band rasters out of a list of zip members or file paths, sorted."""
+    return sorted(
+        name for name in names
+        if any(fnmatchcase(os.path.basename(name), pattern) for pattern in (BAND_FILE_PATTERN, *SCL_FILE_PATTERNS))
+        and not os.path.basename(name).startswith("._")
+        and not name.startswith("__MACOSX/")
+    )
+
+
+@contextmanager
+def open_scene(source):
+    """
+    Give access to the band rasters of a scene without extracting anything to disk.
+    source is the zip content as bytes, a path to a zip file or a folder of TIFFs.
+    Yields (band_files, open_band), where open_band(band_file) returns a rasterio dataset.
+    """
+    import rasterio as rio
+    from rasterio.io import ZipMemoryFile
+
+    if isinstance(source, (bytes, bytearray)):
+        with zipfile.ZipFile(BytesIO(source)) as zip_ref:
+            band_files = list_band_members(zip_ref.namelist())
+        with ZipMemoryFile(bytes(source)) as scene_zip:
+            yield band_files, lambda band_file: scene_zip.open(band_file)
+    elif os.path.isdir(source):
+        yield list_band_members(glob(os.path.join(source, "*"))), lambda band_file: rio.open(band_file, 'r')
+    else:
+        with zipfile.ZipFile(source) as zip_ref:
+            band_files = list_band_members(zip_ref.namelist())
+        zip_path = os.path.abspath(source)
+        yield band_files, lambda band_file: rio.open(f"/vsizip/{zip_path}/{band_file}", 'r')
+
+
+# Sentinel-2 band names in spectral order
+SENTINEL2_BANDS = ["B01", "B02", "B03", "B04", "B05", "B06", "B07",
+                   "B08", "B8A", "B09", "B10", "B11", "B12"]
+
+# Threads used to read band files concurrently (GDAL releases the GIL while reading)
+BAND_READ_WORKERS = int(os.getenv("AGRISAT_READ_WORKERS", min(8, os.cpu_count() or 1)))
+
+_BAND_NAME_PATTERN = re.compile(r"(?<![A-Za-z0-9])B(8A|\d{1,2})(?![0-9A-Za-z])", re.IGNORECASE)
+
+
+def parse_band_name(filename):
+    """
+    Return the Sentinel-2 band name (e.g. "B04", "B8A", or "SCL" for the scene
+    classification) encoded in a file name, or None when the name does not
+    identify a known band.
+    """
+    if any(fnmatchcase(os.path.basename(filename), pattern) for pattern in SCL_FILE_PATTERNS):
+        return "SCL"
+    matches = _BAND_NAME_PATTERN.findall(os.path.basename(filename))
+    if not matches:
+        return None
+    token = matches[-1].upper()
+    band = "B8A" if token == "8A" else f"B{int(token):02d}"
+    return band if band in SENTINEL2_BANDS else None
+
+
+def map_band_files(band_files):
+    """
+    Map band files to Sentinel-2 band names, in spectral order (SCL last).
+    Returns (mapping, unrecognized); raises ValueError if a band appears twice.
+    """
+    mapping, unrecognized = {}, []
+    for band_file in band_files:
+        band = parse_band_name(band_file)
+        if band is None:
+            unrecognized.append(band_file)
+        elif band in mapping:
+            raise ValueError(f"Band {band} found in both {mapping[band]} and {band_file}")
+        else:
+            mapping[band] = band_file
+    ordered = {band: mapping[band] for band in SENTINEL2_BANDS + ["SCL"] if band in mapping}
+    return ordered, unrecognized
+
+
+# Acquisition date (2025-02-26, 20250226 or 20250226T050851) and MGRS tile (T43PGN) in band file names
+_ACQUISITION_DATE_PATTERN = re.compile(r"(?<!\d)(\d{4})-?(\d{2})-?(\d{2})(?!\d)")
+_TILE_PATTERN = re.compile(r"(?<![A-Za-z0-9])T(\d{2}[A-Z]{3})(?![A-Za-z0-9])")
+
+
+def parse_acquisition(filename):
+    """Return (acquisition date as YYYY-MM-DD or None, tile ID such as "T43PGN" or None) from a file name."""
+    name = os.path.basename(filename)
+    acquired = None
+    for year, month, day in _ACQUISITION_DATE_PATTERN.findall(name.replace("T", " ")):
+        try:
+            acquired = datetime(int(year), int(month), int(day)).date().isoformat()
+            break
+        except ValueError:
+            continue
+    tile = _TILE_PATTERN.search(name)
+    return acquired, f"T{tile.group(1)}" if tile else None
+
+
+def scene_acquisition(source):
+    """(acquisition date, tile ID) of a scene, from the first band file name that has them."""
+    acquired = tile = None
+    with open_scene(source) as (band_files, _):
+        for band_file in band_files:
+            file_date, file_tile = parse_acquisition(band_file)
+            acquired, tile = acquired or file_date, tile or file_tile
+            if acquired and tile:
+                break
+    return acquired, tile
+
+
+def parse_field_boundary(geojson=None, bbox=None):
+    """
+    Turn a GeoJSON document (text, bytes or dict) or a (min_lon, min_lat, max_lon,
+    max_lat) bounding box into a list of GeoJSON geometries in WGS84 (EPSG:4326).
+    Returns None when neither is given.
+    """
+    if geojson is not None:
+        document = json.loads(geojson) if isinstance(geojson, (str, bytes)) else geojson
+        if document.get("type") == "FeatureCollection":
+            geometries = [feature["geometry"] for feature in document["features"]]
+        elif document.get("type") == "Feature":
+            geometries = [document["geometry"]]
+        else:
+            geometries = [document]
+        geometries = [geometry for geometry in geometries if geometry]
+        if not geometries:
+            raise ValueError("The GeoJSON file contains no geometries")
+        return geometries
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = (float(value) for value in bbox)
+        if min_lon >= max_lon or min_lat >= max_lat:
+            raise ValueError("The bounding box must be min lon, min lat, max lon, max lat")
+        return [{"type": "Polygon", "coordinates": [[
+            [min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]
+        ]]}]
+    return None
+
+
+def field_boundary_key(geometries):
+    """Short hash identifying a field boundary, for cache keys."""
+    return hashlib.sha256(json.dumps(geometries, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def analysis_key(digest, boundary=None, resolution=None):
+    """Cache and store key of one scene analysed for a field boundary and resolution."""
+    if boundary is not None:
+        digest = f"{digest}-{field_boundary_key(boundary)}"
+    if resolution is not None:
+        digest = f"{digest}-{resolution}m"
+    return digest
+
+
+def field_window(crs, transform, width, height, geometries):
+    """
+    Window of a width x height raster (crs, transform) covering the bounding box
+    of the field geometries (WGS84), and the geometries reprojected to crs.
+    """
+    from rasterio.crs import CRS
+    from rasterio.features import bounds as feature_bounds
+    from rasterio.warp import transform_geom
+    from rasterio.windows import Window, from_bounds
+
+    if crs and crs != CRS.from_epsg(4326):
+        geometries = [transform_geom("EPSG:4326", crs, geometry) for geometry in geometries]
+    all_bounds = [feature_bounds(geometry) for geometry in geometries]
+    left, bottom = min(b[0] for b in all_bounds), min(b[1] for b in all_bounds)
+    right, top = max(b[2] for b in all_bounds), max(b[3] for b in all_bounds)
+
+    window = from_bounds(left, bottom, right, top, transform=transform)
+    col_start, row_start = max(int(np.floor(window.col_off)), 0), max(int(np.floor(window.row_off)), 0)
+    col_stop = min(int(np.ceil(window.col_off + window.width)), width)
+    row_stop = min(int(np.ceil(window.row_off + window.height)), height)
+    if col_stop <= col_start or row_stop <= row_start:
+        raise ValueError("The field boundary does not overlap the uploaded scene")
+
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start), geometries
+
+
+# Analysis resolutions offered besides the native grid of the finest band, in metres
+TARGET_RESOLUTIONS = (10, 20, 60)
+
+
+def pixel_size_metres(crs, transform):
+    """Approximate ground size of one pixel in metres (geographic CRSs use the local scale)."""
+    size = np.sqrt(abs(transform.a * transform.e))
+    if crs is not None and crs.is_geographic:
+        latitude = np.radians(transform.f + transform.e / 2)
+        size *= 111320 * np.sqrt(max(np.cos(latitude), 1e-6))
+    return float(size)
+
+
+def _band_header(open_band, band_file):
+    """Georeferencing of one band raster without reading its pixels."""
+    with open_band(band_file) as src:
+        return {"crs": src.crs, "transform": src.transform, "height": src.height, "width": src.width,
+                "dtype": src.dtypes[0]}
+
+
+def target_grid(headers, boundary=None, resolution=None, decimation=1):
+    """
+    Grid every band of a scene is read onto: the grid of the finest band, cropped
+    to the field boundary, coarsened (or refined) to resolution metres per pixel
+    and then by decimation. Returns a dict with crs, transform, height, width and
+    the field geometries in that CRS (None without a boundary).
+    """
+    from rasterio.transform import Affine
+    from rasterio.windows import Window, transform as window_transform
+
+    reference = min(headers, key=lambda header: abs(header["transform"].a * header["transform"].e))
+    crs, transform = reference["crs"], reference["transform"]
+    window, geometries = Window(0, 0, reference["width"], reference["height"]), None
+    if boundary is not None:
+        window, geometries = field_window(crs, transform, reference["width"], reference["height"], boundary)
+    transform = window_transform(window, transform)
+
+    scale = decimation
+    if resolution:
+        scale *= resolution / pixel_size_metres(crs, transform)
+    height = max(1, int(np.ceil(window.height / scale - 1e-6)))
+    width = max(1, int(np.ceil(window.width / scale - 1e-6)))
+    if (height, width) != (window.height, window.width):
+        transform = transform * Affine.scale(window.width / width, window.height / height)
+    return {"crs": crs, "transform": transform, "height": height, "width": width, "geometries": geometries}
+
+
+class BandStack(dict):
+    """
+    Band arrays of one scene keyed by Sentinel-2 band name, in spectral order.
+    profile holds the georeferencing of the arrays (crs, transform, shape);
+    region, when a field boundary was given, marks the pixels inside the field.
+    The validity mask (pixels that are not nodata, cloud or outside the field
+    in any band) is kept packed, one bit per pixel; None means all are valid.
+    """
+
+    def __init__(self, bands=(), profile=None, region=None, mask=None):
+        super().__init__(bands)
+        self.profile = profile or {}
+        self.region = region
+        self._mask_shape = None if mask is None else mask.shape
+        self._packed_mask = None if mask is None else np.packbits(mask, axis=None)
+
+    @property
+    def mask(self):
+        """Boolean validity mask (True = valid), unpacked on access, or None."""
+        if self._packed_mask is None:
+            return None
+        size = self._mask_shape[0] * self._mask_shape[1]
+        return np.unpackbits(self._packed_mask, count=size).view(bool).reshape(self._mask_shape)
+
+    @property
+    def shape(self):
+        """(height, width) shared by every band."""
+        return next(iter(self.values())).shape if self else (0, 0)
+
+
+def band_validity(band_data, nodata=None):
+    """Mask of the pixels of a band that are finite and not nodata, or None if all are."""
+    valid = np.isfinite(band_data) if np.issubdtype(band_data.dtype, np.floating) else None
+    if nodata is not None and not np.isnan(nodata):
+        valid = band_data != nodata if valid is None else np.logical_and(valid, band_data != nodata, out=valid)
+    return valid
+
+
+def _grid_resampling(src, grid, quick=False):
+    """
+    Resampling of a band onto the common grid: coarser bands are interpolated,
+    finer ones averaged; a quick look takes the nearest pixel instead.
+    """
+    from rasterio.enums import Resampling
+
+    ratio = abs(grid["transform"].a) / abs(src.transform.a)
+    if quick or abs(ratio - 1) < 1e-6:
+        return Resampling.nearest
+    return Resampling.average if ratio > 1 else Resampling.bilinear
+
+
+def _grid_window(src, grid):
+    """The window of src covering the grid when it is pixel-aligned and inside the band, else None."""
+    from rasterio.transform import array_bounds
+    from rasterio.windows import Window, from_bounds
+
+    if src.crs != grid["crs"]:
+        return None
+    bounds = array_bounds(grid["height"], grid["width"], grid["transform"])
+    exact = from_bounds(*bounds, transform=src.transform)
+    window = Window(*(int(round(value)) for value in exact.flatten()))
+    aligned = np.allclose(exact.flatten(), window.flatten(), atol=1e-6)
+    inside = (window.col_off >= 0 and window.row_off >= 0
+              and window.col_off + window.width <= src.width
+              and window.row_off + window.height <= src.height)
+    return window if aligned and inside else None
+
+
+def _warped_to_grid(src, grid, resampling):
+    """WarpedVRT of src on the grid; float bands get NaN outside their footprint."""
+    from rasterio.vrt import WarpedVRT
+
+    nodata = np.nan if np.issubdtype(np.dtype(src.dtypes[0]), np.floating) else None
+    return WarpedVRT(src, crs=grid["crs"], transform=grid["transform"], width=grid["width"],
+                     height=grid["height"], resampling=resampling, nodata=nodata)
+
+
+def _read_band(open_band, band_file, grid, quick=False):
+    """
+    Read the first band of one raster onto the common grid. Returns the band as
+    stored and the mask of its valid pixels (see band_validity). Bands on a
+    coarser grid are interpolated, finer ones averaged; a quick look takes the
+    nearest pixel instead (from the file's overviews when it has them). Grids
+    that are not aligned with the band are warped.
+    """
+    out_shape = (grid["height"], grid["width"])
+    with open_band(band_file) as src:
+        resampling = _grid_resampling(src, grid, quick)
+        window = _grid_window(src, grid)
+        if window is not None:
+            band_data = src.read(1, window=window, out_shape=out_shape, resampling=resampling)
+        else:
+            with _warped_to_grid(src, grid, resampling) as vrt:
+                band_data = vrt.read(1)
+        nodata = src.nodata
+    return band_data, band_validity(band_data, nodata)
+
+
+@contextmanager
+def _open_on_grid(open_band, band_file, grid, quick=False):
+    """
+    Open one band raster for block reads on the common grid, resampled as in
+    _read_band. Yields {"read", "nodata", "tile"}: read(window) returns that
+    window of the grid, tile is the band's internal tile shape (None if striped).
+    """
+    from rasterio.windows import bounds, from_bounds
+
+    with open_band(band_file) as src:
+        resampling = _grid_resampling(src, grid, quick)
+        if _grid_window(src, grid) is not None:
+            # Fractional source windows resample each block exactly as the whole band
+            def read(block):
+                window = from_bounds(*bounds(block, grid["transform"]), transform=src.transform)
+                return src.read(1, window=window, out_shape=(block.height, block.width), resampling=resampling)
+
+            tile = src.block_shapes[0] if src.profile.get("tiled") else None
+            yield {"read": read, "nodata": src.nodata, "tile": tile}
+        else:
+            with _warped_to_grid(src, grid, resampling) as vrt:
+                yield {"read": lambda block: vrt.read(1, window=block), "nodata": src.nodata, "tile": None}
+
+
+def load_bands_and_compute_indices(source, boundary=None, decimation=1, resolution=None, names=None):
+    """
+    Load Sentinel bands from the TIFF files of a scene, reading files concurrently.
+    source is the uploaded zip as bytes, a zip path or a folder (see open_scene).
+    Bands of different resolutions are resampled at read time onto one grid: the
+    finest band's, or resolution metres per pixel (see TARGET_RESOLUTIONS).
+    boundary (see parse_field_boundary) restricts reading to the field's pixels;
+    decimation > 1 loads a 1/decimation resolution quick look. Only the bands
+    the indices in names (all indices by default) read are loaded.
+    Nodata, non-finite, cloudy (from an SCL raster in the scene) and out-of-field
+    pixels are not copied or overwritten but recorded in one validity mask.
+    Returns a BandStack keyed by band name (B02, B04, B08, ...) or None if error occurs.
+    """
+    try:
+        with instrument_stage("band_io") as stage, open_scene(source) as (sentinel_bands, open_band):
+            if not sentinel_bands:
+                report("error", "No band files found in the uploaded data")
+                return None
+
+            band_files, unrecognized = map_band_files(sentinel_bands)
+            if unrecognized:
+                report("warning", f"Ignoring files without a recognizable band name: {', '.join(unrecognized)}")
+            scl_file = band_files.pop("SCL", None)
+            band_files = index_band_files(band_files, names)
+            if not band_files:
+                report("error", "No valid band data found")
+                return None
+
+            grid = target_grid([_band_header(open_band, band_file) for band_file in band_files.values()],
+                               boundary, resolution, decimation)
+
+            # Load bands in parallel; results keep the spectral order of band_files
+            workers = max(1, min(BAND_READ_WORKERS, len(band_files)))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(lambda band_file: _read_band(open_band, band_file, grid, decimation > 1),
+                                        band_files.values()))
+                # Classes are read with nearest-neighbour resampling, never averaged
+                scene_classes = _read_band(open_band, scl_file, grid, quick=True)[0] if scl_file else None
+            stage.add_bytes(sum(band_data.nbytes for band_data, _ in results))
+
+        # One validity mask instead of NaN-filled copies of each band
+        mask = None
+        for valid in (valid for _, valid in results):
+            if valid is not None:
+                mask = valid if mask is None else np.logical_and(mask, valid, out=mask)
+        if scene_classes is not None:
+            clear = ~np.isin(scene_classes, SCL_INVALID_CLASSES)
+            mask = clear if mask is None else np.logical_and(mask, clear, out=mask)
+        region = None
+        if grid["geometries"] is not None:
+            from rasterio.features import geometry_mask
+            region = geometry_mask(grid["geometries"], out_shape=(grid["height"], grid["width"]),
+                                   transform=grid["transform"], invert=True, all_touched=True)
+            mask = region.copy() if mask is None else np.logical_and(mask, region, out=mask)
+
+        profile = {key: grid[key] for key in ("crs", "transform", "height", "width")}
+        return BandStack(zip(band_files, (band_data for band_data, _ in results)), profile, region, mask)
+            
+    except Exception as e:
+        report("error", f"Error loading satellite bands: {str(e)}")
+        return None
+
+
+# Language model settings; they are part of the insights cache key
+INSIGHTS_BACKEND = os.getenv("AGRISAT_INSIGHTS_BACKEND", "groq")
+INSIGHTS_MODEL = os.getenv("AGRISAT_INSIGHTS_MODEL", "gemma2-9b-it")
+INSIGHTS_TEMPERATURE = 0.7
+INSIGHTS_MAX_TOKENS = 1000
+
+# Directory holding cached insights, one JSON file per prompt/model combination
+INSIGHTS_CACHE_DIR = os.getenv("AGRISAT_INSIGHTS_CACHE", ".insights_cache")
+
+
+def build_insights_prompt(analysis_summary):
+    """Prompt sent to the language model for one analysis summary."""
+    return f"""
+You are an agricultural expert helping farmers understand their field conditions based on satellite data.
+Please analyze this data and provide practical advice in simple, non-technical language. Additionally, give a detailed technical analysis.
+
+{analysis_summary}
+
+Please format your response as follows:
+1. Simple Summary
+2. Key Actions
+3. Timing
+4. Warnings
+"""
+
+
+class GroqBackend:
+    """Streams chat completions from Groq, reusing one HTTP client across calls."""
+
+    name = "groq"
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key or os.getenv("GROQ_API_KEY")
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from groq import Groq
+                self._client = Groq(api_key=self.api_key)
+            return self._client
+
+    def stream(self, prompt, model, temperature, max_tokens):
+        """Yield response text as the tokens arrive."""
+        response = self.client.chat.completions.create(
+            messages=[{"role": "user", "content": prompt}],
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class LocalStubBackend:
+    """
+    Offline backend that echoes the satellite summary in the expected format.
+    Lets the pipeline be tested and benchmarked without network access.
+    """
+
+    name = "stub"
+
+    def __init__(self, delay=float(os.getenv("AGRISAT_STUB_DELAY", 0.0))):
+        self.delay = delay
+
+    def stream(self, prompt, model, temperature, max_tokens):
+        """Yield a deterministic response word by word."""
+        findings = [re.sub(r"^\d+\.\s*", "", line.strip()) for line in prompt.splitlines()
+                    if re.match(r"^\d+\. .+:", line.strip())]
+        text = "\n".join([
+            "1. Simple Summary",
+            "Offline insights generated from the satellite summary (no language model was called).",
+            "2. Key Actions",
+            *[f"- Review {finding}" for finding in findings],
+            "3. Timing",
+            "- Re-check the field with the next satellite pass.",
+            "4. Warnings",
+            "- These are placeholder insights from the local stub backend.",
+        ])
+        for word in re.findall(r"\S+\s*", text)[:max_tokens]:
+            if self.delay:
+                time.sleep(self.delay)
+            yield word
+
+
+INSIGHTS_BACKENDS = {"groq": GroqBackend, "stub": LocalStubBackend}
+
+@st.cache_resource
+def _insights_state():
+    """
+    Backends and running jobs shared by every rerun and session. Streamlit
+    re-executes this script on each rerun, so plain module globals would reset.
+    """
+    return {"backends": {}, "jobs": {}, "lock": threading.Lock()}
+
+
+def get_insights_backend(name=None):
+    """Shared backend instance by name (defaults to AGRISAT_INSIGHTS_BACKEND)."""
+    name = name or INSIGHTS_BACKEND
+    state = _insights_state()
+    with state["lock"]:
+        if name not in state["backends"]:
+            if name not in INSIGHTS_BACKENDS:
+                raise ValueError(f"Unknown insights backend: {name}")
+            state["backends"][name] = INSIGHTS_BACKENDS[name]()
+        return state["backends"][name]
+
+
+def insights_cache_key(prompt, backend_name, model=INSIGHTS_MODEL,
+                       temperature=INSIGHTS_TEMPERATURE, max_tokens=INSIGHTS_MAX_TOKENS):
+    """Hash of the prompt and every parameter that changes the response."""
+    payload = json.dumps([prompt, backend_name, model, temperature, max_tokens])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _read_cached_insights(key):
+    """Return insights cached on disk for key, or None."""
+    try:
+        with open(os.path.join(INSIGHTS_CACHE_DIR, f"{key}.json"), encoding="utf-8") as f:
+            return json.load(f)["text"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write_cached_insights(key, text):
+    """Store insights on disk atomically so readers never see a partial file."""
+    os.makedirs(INSIGHTS_CACHE_DIR, exist_ok=True)
+    path = os.path.join(INSIGHTS_CACHE_DIR, f"{key}.json")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"text": text, "created": datetime.now().isoformat()}, f)
+    os.replace(tmp_path, path)
+
+
+class InsightsJob:
+    """
+    Generates insights on a background thread. Any number of readers can
+    replay the streamed text from the start while generation continues.
+    """
+
+    def __init__(self, key, backend, prompt, instrumentation=None):
+        self.key = key
+        self.instrumentation = instrumentation or Instrumentation()
+        self.chunks = []
+        self.error = None
+        self.done = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, args=(backend, prompt), daemon=True)
+        self._thread.start()
+
+    def _run(self, backend, prompt):
+        try:
+            with self.instrumentation.stage("llm"):
+                for piece in backend.stream(prompt, INSIGHTS_MODEL, INSIGHTS_TEMPERATURE, INSIGHTS_MAX_TOKENS):
+                    with self._condition:
+                        self.chunks.append(piece)
+                        self._condition.notify_all()
+            _write_cached_insights(self.key, "".join(self.chunks))
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._condition:
+                self.done = True
+                self._condition.notify_all()
+            state = _insights_state()
+            with state["lock"]:
+                state["jobs"].pop(self.key, None)
+
+    def stream(self):
+        """Yield the response text as it is generated."""
+        position = 0
+        while True:
+            with self._condition:
+                while position >= len(self.chunks) and not self.done:
+                    self._condition.wait()
+                pieces = self.chunks[position:]
+                position += len(pieces)
+                finished = self.done and position >= len(self.chunks)
+            yield from pieces
+            if finished:
+                break
+        if self.error is not None:
+            yield f"\n\nError generating insights: {str(self.error)}"
+
+    def result(self):
+        """Block until generation finishes and return the full text."""
+        return "".join(self.stream())
+
+
+def start_farmer_insights(analysis_summary, backend=None):
+    """
+    Start generating insights in the background.
+    Returns the cached text when this summary was answered before, otherwise
+    the running InsightsJob (shared by every rerun asking for the same prompt).
+    """
+    backend = backend or get_insights_backend()
+    prompt = build_insights_prompt(analysis_summary)
+    key = insights_cache_key(prompt, backend.name)
+    cached = _read_cached_insights(key)
+    if cached is not None:
+        return cached
+    state = _insights_state()
+    with state["lock"]:
+        job = state["jobs"].get(key)
+        if job is None:
+            instrumentation = get_instrumentation() if INSTRUMENTATION_ENABLED else None
+            job = state["jobs"][key] = InsightsJob(key, backend, prompt, instrumentation)
+    return job
+
+
+def get_farmer_insights(analysis_summary, backend=None):
+    """Generate farming insights (Groq by default), blocking until complete."""
+    try:
+        insights = start_farmer_insights(analysis_summary, backend)
+        return insights if isinstance(insights, str) else insights.result()
+    except Exception as e:
+        return f"Error generating insights: {str(e)}"
+
+
+# Every index is declared once as an expression over Sentinel-2 band names.
+# nd(a, b) is the normalized difference (a - b) / (a + b). range is the span the
+# statistics histogram resolves finely (values outside still count, coarsely).
+# Optional indices are only computed when their bands are uploaded, without a
+# warning otherwise. Adding an index is a one-entry change; the evaluation plan,
+# the dropdown and exports pick it up.
+INDEX_REGISTRY = {
+    "NDVI": {"title": "NDVI (Normalized Difference Vegetation Index)",
+             "expression": "nd(B08, B04)",
+             "range": (-1, 1)},
+    "SAVI": {"title": "SAVI (Soil Adjusted Vegetation Index)",
+             "expression": "(B08 - B04) / (B08 + B04 + 0.5) * 1.5",
+             "range": (-1.5, 1.5)},
+    "VARI": {"title": "VARI (Visible Atmospherically Resistant Index)",
+             "expression": "(B03 - B04) / (B03 + B04 - B02)",
+             "range": (-5, 5)},
+    "MNDWI": {"title": "MNDWI (Modified Normalized Difference Water Index)",
+              "expression": "nd(B02, B04)",
+              "range": (-1, 1)},
+    "NDMI": {"title": "NDMI (Normalized Difference Moisture Index)",
+             "expression": "nd(B08, B04)",
+             "range": (-1, 1)},
+    "CMR": {"title": "CMR (Chlorophyll/Moisture Ratio)",
+            "expression": "B08 / B06",
+            "range": (0, 10)},
+    "FMR": {"title": "FMR (Floating Mat Recognition)",
+            "expression": "B08 / B06",
+            "range": (0, 10)},
+    "EVI": {"title": "EVI (Enhanced Vegetation Index)",
+            "expression": "2.5 * (B08 - B04) / (B08 + 6 * B04 - 7.5 * B02 + 1)",
+            "range": (-5, 5)},
+    "NBR": {"title": "NBR (Normalized Burn Ratio)",
+            "expression": "nd(B08, B07)",
+            "range": (-1, 1)},
+    "GCI": {"title": "GCI (Green Chlorophyll Index)",
+            "expression": "B08 / B02 - 1",
+            "range": (-1, 20)},
+    "TCARI": {"title": "TCARI (Transformed Chlorophyll Absorption in Reflectance Index)",
+              "expression": "3 * ((B04 - B02) - 0.2 * (B04 - B03) * (B04 / B02))",
+              "range": (-5, 5)},
+    "BAI": {"title": "BAI (Burn Area Index)",
+            "expression": "1 / ((0.1 - B03) ** 2 + (0.06 - B04) ** 2)",
+            # Reflectance near the (0.1, 0.06) convergence point makes BAI heavy-tailed
+            "range": (0.01, 1e8), "scale": "log"},
+    "OSAVI": {"title": "OSAVI (Optimized Soil-Adjusted Vegetation Index)",
+              "expression": "(B08 - B04) / (B08 + B04 + 0.16)",
+              "range": (-1, 1)},
+    # NDMI above keeps this app's NIR/red form; water content needs shortwave infrared
+    "NDMI_SWIR": {"title": "NDMI-SWIR (Moisture Index from Shortwave Infrared)",
+                  "expression": "nd(B08, B11)",
+                  "range": (-1, 1), "optional": True},
+}
+
+# Short names of the indices, in the order returned by compute_indices
+INDEX_SHORT_NAMES = list(INDEX_REGISTRY)
+
+# Band names of a stacked array, by position (uploads sorted by filename, B01 first)
+POSITIONAL_BAND_NAMES = ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08"]
+
+_BINARY_OPS = {ast.Add: "add", ast.Sub: "sub", ast.Mult: "mul", ast.Div: "div", ast.Pow: "pow"}
+_COMMUTATIVE_OPS = {"add", "mul"}
+_UFUNCS = {"add": np.add, "sub": np.subtract, "mul": np.multiply, "div": np.divide, "pow": np.power}
+_FOLD_OPS = {"add": lambda a, b: a + b, "sub": lambda a, b: a - b, "mul": lambda a, b: a * b,
+             "div": lambda a, b: a / b, "pow": lambda a, b: a ** b}
+
+
+def _compile_expression(node, steps, keys):
+    """
+    Translate an expression AST into plan steps, returning the key of its result.
+    Keys are canonical tuples, so identical subexpressions map to one step.
+    """
+    if isinstance(node, ast.Expression):
+        return _compile_expression(node.body, steps, keys)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return ("const", float(node.value))
+    if isinstance(node, ast.Name):
+        return ("band", node.id)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        operand = _compile_expression(node.operand, steps, keys)
+        return _add_step("sub", ("const", 0.0), operand, steps, keys)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "nd":
+        a, b = (_compile_expression(arg, steps, keys) for arg in node.args)
+        difference = _add_step("sub", a, b, steps, keys)
+        total = _add_step("add", a, b, steps, keys)
+        return _add_step("div", difference, total, steps, keys)
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+        left = _compile_expression(node.left, steps, keys)
+        right = _compile_expression(node.right, steps, keys)
+        return _add_step(_BINARY_OPS[type(node.op)], left, right, steps, keys)
+    raise ValueError(f"Unsupported index expression: {ast.dump(node)}")
+
+
+def _add_step(op, left, right, steps, keys):
+    """Register op(left, right) once, folding constants and ordering commutative operands."""
+    if left[0] == "const" and right[0] == "const":
+        return ("const", _FOLD_OPS[op](left[1], right[1]))
+    if op in _COMMUTATIVE_OPS and repr(right) < repr(left):
+        left, right = right, left
+    key = (op, left, right)
+    if key not in keys:
+        keys.add(key)
+        steps.append(key)
+    return key
+
+
+@lru_cache(maxsize=None)
+def compile_index_plan(names=None):
+    """
+    Compile the requested indices into one evaluation plan.
+    Returns (steps, outputs, bands): steps in dependency order with shared
+    subexpressions listed once, the result key of each index, and the bands used.
+    """
+    names = tuple(names) if names else tuple(INDEX_REGISTRY)
+    steps, keys, outputs = [], set(), {}
+    for name in names:
+        tree = ast.parse(INDEX_REGISTRY[name]["expression"], mode="eval")
+        outputs[name] = _compile_expression(tree, steps, keys)
+    bands = sorted({arg[1] for step in steps for arg in step[1:] if arg[0] == "band"})
+    return steps, outputs, bands
+
+
+# Pixels per row chunk when only the valid pixels of a scene are evaluated
+MASKED_CHUNK_PIXELS = 256 * 1024
+
+
+def _evaluate_valid_pixels(bands, names, mask, outputs, needed):
+    """
+    evaluate_indices restricted to the valid pixels, chunk by chunk: row chunks
+    without valid pixels (e.g. under a cloud bank) are not evaluated at all and
+    invalid pixels of the other chunks are set to NaN. Packing scattered valid
+    pixels together costs more than it saves, so chunks are evaluated whole.
+    """
+    height, width = mask.shape
+    names = tuple(names) if names else None
+    # Indices with the same expression share one output array, as in evaluate_indices
+    arrays = {key: np.empty(mask.shape, dtype=np.float32) for key in set(outputs.values())}
+    rows = max(1, MASKED_CHUNK_PIXELS // width)
+    for row in range(0, height, rows):
+        stop = min(row + rows, height)
+        valid = mask[row:stop]
+        if not valid.any():
+            for array in arrays.values():
+                array[row:stop] = np.nan
+            continue
+        chunk = evaluate_indices({band: bands[band][row:stop] for band in needed}, names)
+        # Adding 0 or NaN is branch-free, much faster than a masked copy on speckled masks
+        poison = None if valid.all() else np.where(valid, np.float32(0), np.float32(np.nan))
+        for key in arrays:
+            name = next(name for name, output in outputs.items() if output == key)
+            if poison is None:
+                arrays[key][row:stop] = chunk[name]
+            else:
+                np.add(chunk[name], poison, out=arrays[key][row:stop])
+    return {name: arrays[key] for name, key in outputs.items()}
+
+
+def evaluate_indices(bands, names=None, mask=None):
+    """
+    Evaluate the requested indices (all by default) over a mapping of band name
+    to array. Runs in float32, computing each shared subexpression once and
+    reusing intermediate buffers in place. Non-finite results become NaN.
+    With a validity mask, invalid pixels are NaN and row chunks without valid
+    pixels are skipped.
+    Returns a dict of index name to array; indices with the same expression
+    share one array.
+    """
+    steps, outputs, needed = compile_index_plan(tuple(names) if names else None)
+    missing = [band for band in needed if band not in bands]
+    if missing:
+        raise ValueError(f"Missing bands for index computation: {', '.join(missing)}")
+
+    if mask is not None:
+        return _evaluate_valid_pixels(bands, names, mask, outputs, needed)
+
+    values = {("band", band): np.asarray(bands[band], dtype=np.float32) for band in needed}
+    shape = values[("band", needed[0])].shape if needed else ()
+    output_keys = set(outputs.values())
+
+    # Last step at which each intermediate is read, so its buffer can be recycled
+    last_use = {}
+    for position, step in enumerate(steps):
+        for arg in step[1:]:
+            last_use[arg] = position
+
+    free_buffers = []
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for position, step in enumerate(steps):
+            op, left, right = step
+            args = [values[arg] if arg[0] != "const" else arg[1] for arg in (left, right)]
+            released = [arg for arg in dict.fromkeys((left, right))
+                        if arg[0] not in ("band", "const") and arg not in output_keys
+                        and last_use[arg] == position]
+
+            if step in output_keys:
+                out = np.empty(shape, dtype=np.float32)
+            elif released:
+                # Write over an operand that nothing reads afterwards
+                out = values[released.pop(0)]
+            elif free_buffers:
+                out = free_buffers.pop()
+            else:
+                out = np.empty(shape, dtype=np.float32)
+
+            if op == "pow" and right == ("const", 2.0):
+                np.square(args[0], out=out)
+            else:
+                _UFUNCS[op](args[0], args[1], out=out)
+            values[step] = out
+
+            for arg in released:
+                free_buffers.append(values.pop(arg))
+
+    results = {}
+    finalized = set()
+    for name, key in outputs.items():
+        result = values[key]
+        if key[0] in ("band", "const"):
+            result = np.full(shape, key[1], dtype=np.float32) if key[0] == "const" else result.copy()
+        if key not in finalized:
+            np.copyto(result, np.nan, where=~np.isfinite(result))
+            finalized.add(key)
+        results[name] = result
+    return results
+
+
+def index_bands(name):
+    """Band names an index expression reads."""
+    return compile_index_plan((name,))[2]
+
+
+def index_band_files(band_files, names=None):
+    """The entries of band_files (band name to file) read by the indices in names, all indices by default."""
+    needed = set(compile_index_plan(tuple(names) if names else None)[2])
+    return {band: band_file for band, band_file in band_files.items() if band in needed}
+
+
+def compute_indices(bands, names=None):
+    """
+    Compute vegetation and environmental indices from satellite bands.
+    bands maps band names (B02, B04, B08, ...) to arrays; a plain stacked array
+    is read positionally as B01, B02, ... for backwards compatibility.
+    Returns a tuple in INDEX_SHORT_NAMES order; indices that were not requested
+    or whose bands are missing are None.
+    """
+    try:
+        if bands is None:
+            raise ValueError("Insufficient band data for index computation")
+        if not isinstance(bands, dict):
+            bands = dict(zip(POSITIONAL_BAND_NAMES, bands))
+
+        requested = list(names) if names else INDEX_SHORT_NAMES
+        available = [name for name in requested if all(band in bands for band in index_bands(name))]
+        skipped = [name for name in requested
+                   if name not in available and (names or not INDEX_REGISTRY[name].get("optional"))]
+        if skipped:
+            missing = sorted({band for name in skipped for band in index_bands(name) if band not in bands})
+            report("warning", f"Skipping {', '.join(skipped)}: missing band(s) {', '.join(missing)}")
+        if not available:
+            raise ValueError("Insufficient band data for index computation")
+
+        with instrument_stage("index_math"):
+            mask = bands.mask if isinstance(bands, BandStack) else None
+            results = evaluate_indices(bands, tuple(available), mask)
+        return tuple(results.get(name) for name in INDEX_SHORT_NAMES)
+
+    except Exception as e:
+        report("error", f"Error computing indices: {str(e)}")
+        return tuple([None] * len(INDEX_SHORT_NAMES))
+
+
+# Pixels processed per block by the windowed engine (~4 MB per float32 band)
+DEFAULT_BLOCK_PIXELS = 1024 * 1024
+
+
+def iter_block_windows(height, width, tile=None, block_pixels=DEFAULT_BLOCK_PIXELS):
+    """
+    Yield rasterio windows covering a height x width raster with about
+    block_pixels pixels each. Tiled rasters (tile is their (rows, cols) block
+    shape) are walked in tile-aligned squares; striped rasters in full-width
+    row strips so no strip is decoded more than once.
+    """
+    from rasterio.windows import Window
+
+    if tile:
+        tile_h, tile_w = tile
+        side = max(int(np.sqrt(block_pixels)), 1)
+        rows = max(side // tile_h, 1) * tile_h
+        cols = max(side // tile_w, 1) * tile_w
+    else:
+        cols = width
+        rows = max(block_pixels // max(width, 1), 1)
+
+    for row_off in range(0, height, rows):
+        for col_off in range(0, width, cols):
+            yield Window(col_off, row_off, min(cols, width - col_off), min(rows, height - row_off))
+
+
+# Fixed histogram bins per index, used to estimate percentiles in one pass
+STATS_HISTOGRAM_BINS = 1024
+STATS_PERCENTILES = (10, 25, 50, 75, 90)
+
+# Pixels reduced per chunk; small enough that a chunk's temporaries stay in cache
+STATS_CHUNK_PIXELS = 256 * 1024
+
+
+class IndexStatsAccumulator:
+    """
+    Streaming statistics for several indices, fed one chunk of pixels at a time.
+    Tracks count, mean, standard deviation, min, max and a fixed-bin histogram
+    (plus under/overflow bins) per index, and how many pixels are valid in
+    every index. Means and variances are merged per chunk (Chan et al.).
+    Indices registered with "scale": "log" are binned by log10 of their value.
+    """
+
+    def __init__(self, names, bins=STATS_HISTOGRAM_BINS):
+        self.bins = bins
+        self.pixels = 0
+        self.valid_pixels = 0
+        self._float_buffer = self._code_buffer = None
+        self._stats = {}
+        for name in names:
+            low, high = INDEX_REGISTRY[name].get("range", (-1, 1))
+            log = INDEX_REGISTRY[name].get("scale") == "log"
+            if log:
+                low, high = np.log10(low), np.log10(high)
+            self._stats[name] = {
+                "count": 0, "mean": 0.0, "m2": 0.0, "min": np.inf, "max": -np.inf,
+                "low": float(low), "high": float(high), "log": log,
+                "histogram": np.zeros(bins + 2, dtype=np.int64),
+            }
+
+    def update(self, chunk, region=None):
+        """
+        Fold a chunk (dict of index name to equally shaped arrays) into the totals.
+        region optionally marks the chunk's pixels that belong to the analysed
+        area; pixels outside it do not count towards the valid fraction.
+        """
+        all_valid = None
+        seen = {}
+        for name, values in chunk.items():
+            values = np.ravel(values)
+            # Indices sharing one array (e.g. NDVI and NDMI) are reduced once
+            memory = (values.ctypes.data, values.size, values.strides)
+            if memory not in seen:
+                finite = np.isfinite(values)
+                valid = values if finite.all() else values[finite]
+                seen[memory] = (finite, self._reduce_chunk(name, valid))
+            finite, partial = seen[memory]
+            self._merge(self._stats[name], partial)
+            all_valid = finite if all_valid is None else all_valid & finite
+
+        if all_valid is not None:
+            if region is None:
+                self.pixels += all_valid.size
+            else:
+                region = np.ravel(region)
+                self.pixels += int(np.count_nonzero(region))
+                all_valid = all_valid & region
+            self.valid_pixels += int(np.count_nonzero(all_valid))
+
+    def _scratch(self, size):
+        """Reusable float and integer buffers, so chunks do not allocate."""
+        if self._float_buffer is None or self._float_buffer.size < size:
+            self._float_buffer = np.empty(size, dtype=np.float32)
+            self._code_buffer = np.empty(size, dtype=np.intp)
+        return self._float_buffer[:size], self._code_buffer[:size]
+
+    def _reduce_chunk(self, name, valid):
+        """Statistics of the finite values of one chunk."""
+        stats = self._stats[name]
+        count = valid.size
+        if count == 0:
+            return None
+        buffer, codes = self._scratch(count)
+        mean = float(valid.sum()) / count
+        np.subtract(valid, np.float32(mean), out=buffer)
+        m2 = float(np.dot(buffer, buffer))
+        # Bin 0 is underflow, bin bins + 1 overflow
+        scale = self.bins / (stats["high"] - stats["low"])
+        if stats["log"]:
+            np.maximum(valid, np.float32(1e-30), out=buffer)
+            np.log10(buffer, out=buffer)
+            buffer *= np.float32(scale)
+        else:
+            np.multiply(valid, np.float32(scale), out=buffer)
+        buffer += np.float32(1 - stats["low"] * scale)
+        np.clip(buffer, 0, self.bins + 1, out=buffer)
+        np.copyto(codes, buffer, casting="unsafe")
+        histogram = np.bincount(codes, minlength=self.bins + 2)
+        return count, mean, m2, float(valid.min()), float(valid.max()), histogram
+
+    @staticmethod
+    def _merge(stats, partial):
+        if partial is None:
+            return
+        count, mean, m2, low, high, histogram = partial
+        total = stats["count"] + count
+        delta = mean - stats["mean"]
+        stats["mean"] += delta * count / total
+        stats["m2"] += m2 + delta * delta * stats["count"] * count / total
+        stats["count"] = total
+        stats["min"] = min(stats["min"], low)
+        stats["max"] = max(stats["max"], high)
+        stats["histogram"] += histogram
+
+    def _percentile(self, stats, percent):
+        """
+        Interpolate a percentile within its histogram bin. Percentiles that fall
+        below or above the index range are unknown and returned as NaN (values
+        exactly at the top of the range count as inside it).
+        """
+        cumulative = np.cumsum(stats["histogram"])
+        rank = percent / 100 * stats["count"]
+        bin_index = min(int(np.searchsorted(cumulative, rank, side="left")), self.bins + 1)
+        high = 10 ** stats["high"] if stats["log"] else stats["high"]
+        if bin_index == self.bins + 1:
+            return high if stats["max"] <= high else np.nan
+        if bin_index == 0:
+            return np.nan
+        before = cumulative[bin_index - 1]
+        in_bin = stats["histogram"][bin_index]
+        fraction = (rank - before) / in_bin if in_bin else 0.0
+        width = (stats["high"] - stats["low"]) / self.bins
+        value = stats["low"] + width * (bin_index - 1 + fraction)
+        if stats["log"]:
+            value = 10 ** value
+        return float(min(max(value, stats["min"]), stats["max"]))
+
+    def result(self):
+        """
+        Final statistics: {"indices": {name: {count, mean, std, min, max, p10..p90,
+        valid_fraction}}, "pixels", "valid_pixels", "valid_fraction"}.
+        """
+        indices = {}
+        for name, stats in self._stats.items():
+            count = stats["count"]
+            entry = {
+                "count": count,
+                "mean": stats["mean"] if count else np.nan,
+                "std": float(np.sqrt(stats["m2"] / count)) if count else np.nan,
+                "min": stats["min"] if count else np.nan,
+                "max": stats["max"] if count else np.nan,
+                "valid_fraction": count / self.pixels if self.pixels else 0.0,
+            }
+            for percent in STATS_PERCENTILES:
+                entry[f"p{percent}"] = self._percentile(stats, percent) if count else np.nan
+            indices[name] = entry
+        return {
+            "indices": indices,
+            "pixels": self.pixels,
+            "valid_pixels": self.valid_pixels,
+            "valid_fraction": self.valid_pixels / self.pixels if self.pixels else 0.0,
+        }
+
+
+def reduce_index_statistics(indices, chunk_pixels=STATS_CHUNK_PIXELS, region=None):
+    """
+    Compute the statistics of every index in a single pass over row chunks.
+    indices maps index names to equally shaped arrays (None entries are skipped);
+    region optionally limits the pixel count to a field (see BandStack.region).
+    Returns IndexStatsAccumulator.result().
+    """
+    indices = {name: index for name, index in indices.items() if index is not None}
+    accumulator = IndexStatsAccumulator(indices)
+    if not indices:
+        return accumulator.result()
+    with instrument_stage("statistics"):
+        shape = next(iter(indices.values())).shape
+        width = shape[-1] if len(shape) > 1 else 1
+        rows = max(chunk_pixels // max(width, 1), 1)
+        for row in range(0, shape[0], rows):
+            accumulator.update({name: index[row:row + rows] for name, index in indices.items()},
+                               None if region is None else region[row:row + rows])
+        return accumulator.result()
+
+
+# Default management-zone cell size in pixels per side (200 m at 10 m resolution)
+ZONE_CELL_PIXELS = 20
+
+
+def _zone_totals(indices, zones):
+    """
+    Per-zone count, sum and sum of squares accumulators by index name, and the
+    (array, accumulators) pairs to reduce: indices sharing an array share one.
+    """
+    totals, seen = {}, {}
+    for name, index in indices.items():
+        memory = (index.ctypes.data, index.shape, index.strides)
+        if memory not in seen:
+            # Sums are taken around the middle of the index range for precision
+            low, high = INDEX_REGISTRY[name].get("range", (-1, 1))
+            middle = np.sqrt(low * high) if INDEX_REGISTRY[name].get("scale") == "log" else (low + high) / 2
+            seen[memory] = (index, {"shift": np.float32(middle), "count": np.zeros(zones, dtype=np.int64),
+                                    "sum": np.zeros(zones), "sum_squares": np.zeros(zones)})
+        totals[name] = seen[memory][1]
+    return totals, list(seen.values())
+
+
+def _reduce_grid_zones(arrays, cell_pixels, grid_shape, region, chunk_pixels):
+    """
+    Fill the totals of grid cell zones by reshaping row chunks to (pixel row,
+    cell column, pixel column) and summing the pixel axes away. Chunks are
+    padded to whole cells; padding is out of scope. Returns pixels per zone.
+    """
+    height, width = arrays[0][0].shape
+    padded_width = grid_shape[1] * cell_pixels
+    rows = max(cell_pixels, chunk_pixels // padded_width // cell_pixels * cell_pixels)
+    values = np.zeros((rows, padded_width), dtype=np.float32)
+    squares = np.empty_like(values)
+    in_scope = np.zeros((rows, padded_width), dtype=bool)
+    pixels = np.zeros(grid_shape[0] * grid_shape[1], dtype=np.int64)
+
+    def cell_sums(array, chunk_rows, dtype):
+        cells = array[:chunk_rows].reshape(chunk_rows, grid_shape[1], cell_pixels).sum(axis=2, dtype=dtype)
+        return cells.reshape(chunk_rows // cell_pixels, cell_pixels, grid_shape[1]).sum(axis=1).ravel()
+
+    for row in range(0, height, rows):
+        stop = min(row + rows, height)
+        chunk_rows = -(-(stop - row) // cell_pixels) * cell_pixels
+        zone_slice = slice(row // cell_pixels * grid_shape[1], (row + chunk_rows) // cell_pixels * grid_shape[1])
+
+        in_scope[:] = False
+        in_scope[:stop - row, :width] = True if region is None else region[row:stop]
+        pixels[zone_slice] += cell_sums(in_scope, chunk_rows, np.int64)
+
+        for index, total in arrays:
+            chunk = values[:chunk_rows]
+            np.subtract(index[row:stop], total["shift"], out=values[:stop - row, :width])
+            valid = np.isfinite(chunk)
+            valid &= in_scope[:chunk_rows]
+            np.copyto(chunk, 0, where=~valid)
+            np.multiply(chunk, chunk, out=squares[:chunk_rows])
+            total["count"][zone_slice] += cell_sums(valid, chunk_rows, np.int64)
+            total["sum"][zone_slice] += cell_sums(values, chunk_rows, np.float64)
+            total["sum_squares"][zone_slice] += cell_sums(squares, chunk_rows, np.float64)
+    return pixels
+
+
+def _reduce_label_zones(arrays, labels, zones, region, chunk_pixels):
+    """
+    Fill the totals of labelled zones with np.bincount over row chunks. Pixels
+    outside every zone go to one extra bin that is dropped. Returns pixels per zone.
+    """
+    height, width = labels.shape
+    rows = max(1, chunk_pixels // width)
+    pixels = np.zeros(zones + 1, dtype=np.int64)
+    for _, total in arrays:
+        for key in ("count", "sum", "sum_squares"):
+            total[key] = np.append(total[key], 0)
+
+    for row in range(0, height, rows):
+        stop = min(row + rows, height)
+        chunk_labels = np.ravel(labels[row:stop]).astype(np.intp)
+        chunk_labels[chunk_labels < 0] = zones
+        if region is not None:
+            chunk_labels[~np.ravel(region[row:stop])] = zones
+        pixels += np.bincount(chunk_labels, minlength=zones + 1)
+
+        for index, total in arrays:
+            values = np.ravel(index[row:stop])
+            finite = np.isfinite(values)
+            valid_labels = chunk_labels
+            if not finite.all():
+                valid_labels, values = chunk_labels[finite], values[finite]
+            deviations = values - total["shift"]
+            total["count"] += np.bincount(valid_labels, minlength=zones + 1)
+            total["sum"] += np.bincount(valid_labels, weights=deviations, minlength=zones + 1)
+            total["sum_squares"] += np.bincount(valid_labels, weights=deviations * deviations, minlength=zones + 1)
+
+    for _, total in arrays:
+        for key in ("count", "sum", "sum_squares"):
+            total[key] = total[key][:zones]
+    return pixels[:zones]
+
+
+def zonal_statistics(indices, cell_pixels=ZONE_CELL_PIXELS, labels=None, region=None,
+                     chunk_pixels=STATS_CHUNK_PIXELS):
+    """
+    Mean, standard deviation and valid fraction of every index per management
+    zone, in one vectorized pass over row chunks. Zones are the cells of a
+    cell_pixels grid (reduced by reshaping), or the values of an integer labels
+    raster (reduced with np.bincount; negative labels belong to no zone).
+    region optionally limits zones to a field.
+    Returns {"pixels", "grid_shape", "indices": {name: {"mean", "std", "valid_fraction"}}}
+    with one array entry per zone; grid_shape is None for labelled zones.
+    """
+    indices = {name: index for name, index in indices.items() if index is not None}
+    if not indices:
+        raise ValueError("No index data for zonal statistics")
+    height, width = next(iter(indices.values())).shape
+
+    with instrument_stage("zonal_statistics"):
+        if labels is None:
+            grid_shape = (-(-height // cell_pixels), -(-width // cell_pixels))
+            totals, arrays = _zone_totals(indices, grid_shape[0] * grid_shape[1])
+            pixels = _reduce_grid_zones(arrays, cell_pixels, grid_shape, region, chunk_pixels)
+        else:
+            grid_shape = None
+            zones = int(labels.max()) + 1
+            if zones <= 0:
+                raise ValueError("The zone raster contains no zones")
+            totals, arrays = _zone_totals(indices, zones)
+            pixels = _reduce_label_zones(arrays, labels, zones, region, chunk_pixels)
+
+    results = {}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for name, total in totals.items():
+            count = total["count"]
+            mean = total["sum"] / count
+            variance = np.maximum(total["sum_squares"] / count - mean * mean, 0)
+            results[name] = {"mean": mean + total["shift"], "std": np.sqrt(variance),
+                             "valid_fraction": np.where(pixels > 0, count / np.maximum(pixels, 1), np.nan)}
+    return {"pixels": pixels, "grid_shape": grid_shape, "indices": results}
+
+
+def zone_map(zones, name, labels=None):
+    """
+    Raster of the per-zone mean of one index: one pixel per cell for grid zones,
+    the zone raster's shape for labelled zones (NaN outside every zone).
+    """
+    mean = zones["indices"][name]["mean"]
+    if zones["grid_shape"] is not None:
+        return mean.reshape(zones["grid_shape"]).astype(np.float32)
+    mean = np.append(mean, np.nan).astype(np.float32)
+    return mean[np.where(labels >= 0, labels, mean.size - 1)]
+
+
+def zone_table(zones, names=None):
+    """Columns (zone, row, col, pixels and index statistics) for the zones that contain pixels."""
+    keep = np.flatnonzero(zones["pixels"])
+    table = {"zone": keep}
+    if zones["grid_shape"] is not None:
+        table["row"], table["col"] = np.divmod(keep, zones["grid_shape"][1])
+    table["pixels"] = zones["pixels"][keep]
+    for name in names or zones["indices"]:
+        for stat, values in zones["indices"][name].items():
+            table[f"{name}_{stat}"] = values[keep]
+    return table
+
 
-def load_bands_and_compute_indices(data_folder):
+def compute_indices_windowed(source, block_pixels=DEFAULT_BLOCK_PIXELS, output_folder=None, names=None,
+                             boundary=None, resolution=None, cog_path=None):
     """
-    Load Sentinel bands from TIFF files and stack them.
-    Returns stacked array of bands or None if error occurs.
+    Compute every index (or those in names) block by block without loading whole
+    bands into memory. source is a scene as accepted by open_scene; boundary and
+    resolution pick the grid and the nodata, SCL and field masks apply as in
+    load_bands_and_compute_indices, so the results match the full-array path.
+    Returns the statistics of every index (see reduce_index_statistics) with the
+    grid's "height" and "width" and the "bands" read. Optionally writes each index as a float32
+    GeoTIFF into output_folder and all of them as one cloud-optimized GeoTIFF at
+    cog_path (see write_indices_cog).
+    Peak memory is proportional to block_pixels, not to the scene size.
     """
-    try:
-        # Find all band files
-        sentinel_bands = glob(os.path.join(data_folder, "*B?*.tiff"))
-        if not sentinel_bands:
-            st.error("No band files found in the uploaded data")
-            return None
-        
-        # Sort bands to ensure consistent order
-        sentinel_bands.sort()
-        
-        # Load each band
-        band_list = []
-        for band_file in sentinel_bands:
-            with rio.open(band_file, 'r') as src:
-                band_data = src.read(1)
-                # Replace potential infinity or invalid values with nan
-                band_data = np.where(np.isfinite(band_data), band_data, np.nan)
-                band_list.append(band_data)
-        
-        # Stack bands into 3D array
-        if band_list:
-            arr_st = np.stack(band_list)
-            return arr_st
-        else:
-            st.error("No valid band data found")
-            return None
-            
-    except Exception as e:
-        st.error(f"Error loading satellite bands: {str(e)}")
-        return None
+    import rasterio as rio
+    from rasterio.features import geometry_mask
+    from rasterio.windows import transform as window_transform
 
-def get_farmer_insights(analysis_summary):
-    """Generate farming insights using Groq AI."""
-    client = Groq(api_key=os.getenv("GROQ_API_KEY"))
-    prompt = f"""
-You are an agricultural expert helping farmers understand their field conditions based on satellite data.
-Please analyze this data and provide practical advice in simple, non-technical language. Additionally, give a detailed technical analysis.
+    with ExitStack() as stack:
+        sentinel_bands, open_band = stack.enter_context(open_scene(source))
+        band_files, _ = map_band_files(sentinel_bands)
+        scl_file = band_files.pop("SCL", None)
+        requested = list(names) if names else INDEX_SHORT_NAMES
+        available = [name for name in requested if all(band in band_files for band in index_bands(name))]
+        skipped = [name for name in requested
+                   if name not in available and (names or not INDEX_REGISTRY[name].get("optional"))]
+        if skipped:
+            missing = sorted({band for name in skipped for band in index_bands(name) if band not in band_files})
+            report("warning", f"Skipping {', '.join(skipped)}: missing band(s) {', '.join(missing)}")
+        if not available:
+            raise ValueError("Insufficient band data for index computation")
+        names = available
+        needed = compile_index_plan(tuple(names))[2]
 
-{analysis_summary}
+        grid = target_grid([_band_header(open_band, band_files[band]) for band in needed], boundary, resolution)
+        height, width = grid["height"], grid["width"]
+        readers = {band: stack.enter_context(_open_on_grid(open_band, band_files[band], grid)) for band in needed}
+        if scl_file:
+            # Classes are read with nearest-neighbour resampling, never averaged
+            readers["SCL"] = stack.enter_context(_open_on_grid(open_band, scl_file, grid, quick=True))
 
-Please format your response as follows:
-1. Simple Summary
-2. Key Actions
-3. Timing
-4. Warnings
-"""
-    try:
-        chat_completion = client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model="gemma2-9b-it",
-            temperature=0.7,
-            max_tokens=1000
-        )
-        return chat_completion.choices[0].message.content
-    except Exception as e:
-        return f"Error generating insights: {str(e)}"
-    
+        writers = {}
+        if output_folder:
+            os.makedirs(output_folder, exist_ok=True)
+            profile = {"driver": "GTiff", "height": height, "width": width, "count": 1, "dtype": "float32",
+                       "crs": grid["crs"], "transform": grid["transform"], "nodata": np.nan,
+                       "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate"}
+            for name in names:
+                path = os.path.join(output_folder, f"{name}.tif")
+                writers[name] = stack.enter_context(rio.open(path, 'w', **profile))
+        cog = stack.enter_context(cog_writer(cog_path, names, height, width, grid)) if cog_path else None
+
+        accumulator = IndexStatsAccumulator(names)
 
+        tile = next((reader["tile"] for reader in readers.values() if reader["tile"]), None)
+        for window in iter_block_windows(height, width, tile, block_pixels):
+            block, mask = {}, None
+            for band, reader in readers.items():
+                band_data = reader["read"](window)
+                if band == "SCL":
+                    valid = ~np.isin(band_data, SCL_INVALID_CLASSES)
+                else:
+                    block[band] = band_data
+                    valid = band_validity(band_data, reader["nodata"])
+                if valid is not None:
+                    mask = valid if mask is None else mask & valid
+            region = None
+            if grid["geometries"] is not None:
+                region = geometry_mask(grid["geometries"], out_shape=(window.height, window.width),
+                                       transform=window_transform(window, grid["transform"]),
+                                       invert=True, all_touched=True)
+                mask = region if mask is None else mask & region
+            block_indices = evaluate_indices(block, tuple(names), mask)
 
+            accumulator.update(block_indices, region)
+            for name, index in block_indices.items():
+                if name in writers:
+                    writers[name].write(index, 1, window=window)
+            if cog is not None:
+                for band, name in enumerate(names, start=1):
+                    cog.write(block_indices[name], band, window=window)
 
-def plot_index_with_interpretation(index, title, cmap="RdYlGn", vmin=-1, vmax=1):
-    """Plot the selected index with appropriate coloring and title."""
-    try:
-        fig, ax = plt.subplots(figsize=(10, 14))
-        ep.plot_bands(index, cmap=cmap, cols=1, vmin=vmin, vmax=vmax, ax=ax)
-        plt.title(title)
-        st.pyplot(fig)
-        plt.close()
-    except Exception as e:
-        st.error(f"Error plotting index: {str(e)}")
+    result = accumulator.result()
+    result["height"], result["width"] = height, width
+    result["bands"] = [band for band in band_files if band in needed]
+    return result
 
 
+# Shared on-disk store of computed index rasters, opened as memory maps
+INDEX_STORE_DIR = os.getenv("AGRISAT_INDEX_STORE", ".index_store")
+INDEX_STORE_MAX_BYTES = int(os.getenv("AGRISAT_INDEX_STORE_BYTES", 20 * 1024 ** 3))
 
-def normalize_band(band):
-    """Normalize band data to 0-1 range."""
-    band_min = np.nanmin(band)
-    band_max = np.nanmax(band)
-    if band_max > band_min:
-        return (band - band_min) / (band_max - band_min)
-    return band
 
-def compute_indices(arr_st):
+def index_definition_version():
+    """Short hash of the index definitions; stored rasters and statistics are only reused while it matches."""
+    definitions = {name: [entry["expression"], entry.get("range"), entry.get("scale")]
+                   for name, entry in INDEX_REGISTRY.items()}
+    payload = json.dumps([definitions, "float32"], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:12]
+
+
+class IndexStore:
     """
-    Compute various vegetation and environmental indices from satellite bands.
-    Returns tuple of computed indices.
+    Computed index arrays saved as .npy files, one folder per scene hash and
+    index definition version. Arrays are opened as read-only memory maps, so
+    every session and batch job reading a scene shares one copy through the
+    page cache. Folders are evicted least recently used first once the store
+    grows past max_bytes.
     """
-    try:
-        if arr_st is None or len(arr_st) < 8:
-            raise ValueError("Insufficient band data for index computation")
 
-        # Normalize bands for consistent calculations
-        bands_normalized = [normalize_band(band) for band in arr_st]
+    def __init__(self, root=INDEX_STORE_DIR, max_bytes=INDEX_STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
 
-        # Calculate indices with error handling
-        def safe_normalized_diff(band1, band2):
-            """Safely compute normalized difference with error handling."""
-            try:
-                return es.normalized_diff(band1, band2)
-            except Exception as e:
-                st.warning(f"Error computing normalized difference: {str(e)}")
-                return np.full_like(band1, np.nan)
+    def scene_dir(self, scene_key):
+        return os.path.join(self.root, f"{scene_key}-{index_definition_version()}")
 
-        # Basic indices
-        ndvi = safe_normalized_diff(arr_st[7], arr_st[3])
-        
-        # Soil Adjusted Vegetation Index
-        L = 0.5
-        try:
-            savi = ((arr_st[7] - arr_st[3]) / (arr_st[7] + arr_st[3] + L)) * (1 + L)
-        except:
-            savi = np.full_like(arr_st[7], np.nan)
-        
-        # Visible Atmospherically Resistant Index
-        try:
-            vari = (arr_st[2] - arr_st[3]) / (arr_st[2] + arr_st[3] - arr_st[1])
-        except:
-            vari = np.full_like(arr_st[2], np.nan)
-        
-        # Modified Normalized Difference Water Index
-        mndwi = safe_normalized_diff(arr_st[1], arr_st[3])
-        
-        # Normalized Difference Moisture Index
-        ndmi_alt = safe_normalized_diff(arr_st[7], arr_st[3])
-        
-        # Chlorophyll/Moisture Ratio
-        try:
-            cmr_alt = np.divide(arr_st[7], arr_st[5])
-        except:
-            cmr_alt = np.full_like(arr_st[7], np.nan)
-        
-        # Floating Mat Recognition
-        try:
-            fmr_alt = np.divide(arr_st[7], arr_st[5])
-        except:
-            fmr_alt = np.full_like(arr_st[7], np.nan)
-        
-        # Enhanced Vegetation Index
-        try:
-            evi = 2.5 * (arr_st[7] - arr_st[3]) / (arr_st[7] + 6 * arr_st[3] - 7.5 * arr_st[1] + 1)
-        except:
-            evi = np.full_like(arr_st[7], np.nan)
-        
-        # Normalized Burn Ratio
-        nbr = safe_normalized_diff(arr_st[7], arr_st[6])
-        
-        # Green Chlorophyll Index
+    def load(self, scene_key):
+        """
+        Return (indices, stats) for a stored scene, or None. indices maps index
+        names to read-only memmaps; stats is the saved statistics (or None).
+        """
+        folder = self.scene_dir(scene_key)
         try:
-            gci = (arr_st[7] / arr_st[1]) - 1
-        except:
-            gci = np.full_like(arr_st[7], np.nan)
-        
-        # Transformed Chlorophyll Absorption in Reflectance Index
+            with open(os.path.join(folder, "manifest.json"), encoding="utf-8") as f:
+                manifest = json.load(f)
+            arrays = {file_name: np.load(os.path.join(folder, file_name), mmap_mode="r")
+                      for file_name in set(manifest["files"].values())}
+            os.utime(folder)  # mark as recently used
+        except (OSError, ValueError, KeyError):
+            return None
+        indices = {name: arrays[file_name] for name, file_name in manifest["files"].items()}
+        return indices, manifest.get("stats")
+
+    def profile(self, scene_key):
+        """Georeferencing (crs, transform) saved with a scene, or None."""
         try:
-            tcari = 3 * ((arr_st[3] - arr_st[1]) - 0.2 * (arr_st[3] - arr_st[2]) * (arr_st[3] / arr_st[1]))
-        except:
-            tcari = np.full_like(arr_st[3], np.nan)
-        
-        # Burn Area Index
+            with open(os.path.join(self.scene_dir(scene_key), "manifest.json"), encoding="utf-8") as f:
+                saved = json.load(f).get("profile")
+        except (OSError, ValueError):
+            return None
+        if not saved:
+            return None
+        from rasterio.crs import CRS
+        from rasterio.transform import Affine
+        return {"crs": CRS.from_wkt(saved["crs"]) if saved["crs"] else None,
+                "transform": Affine(*saved["transform"])}
+
+    def region(self, scene_key):
+        """Field region mask (memory-mapped) saved with a scene, or None for whole scenes."""
+        folder = self.scene_dir(scene_key)
         try:
-            bai = 1 / ((0.1 - arr_st[2])**2 + (0.06 - arr_st[3])**2)
-        except:
-            bai = np.full_like(arr_st[2], np.nan)
-        
-        # Optimized Soil-Adjusted Vegetation Index
+            with open(os.path.join(folder, "manifest.json"), encoding="utf-8") as f:
+                file_name = json.load(f).get("region")
+            return np.load(os.path.join(folder, file_name), mmap_mode="r") if file_name else None
+        except (OSError, ValueError):
+            return None
+
+    def save(self, scene_key, indices, stats=None, profile=None, region=None):
+        """
+        Write a scene's indices (arrays shared between indices are written once),
+        its statistics, georeferencing and field region mask. The folder appears atomically, so readers
+        never see a partial scene; if another process saved it first, its copy is kept.
+        """
+        folder = self.scene_dir(scene_key)
+        if os.path.exists(folder):
+            return
+        os.makedirs(self.root, exist_ok=True)
+        tmp_folder = f"{folder}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_folder, exist_ok=True)
         try:
-            osavi = (arr_st[7] - arr_st[3]) / (arr_st[7] + arr_st[3] + 0.16)
-        except:
-            osavi = np.full_like(arr_st[7], np.nan)
+            files, written = {}, {}
+            for name, index in indices.items():
+                if index is None:
+                    continue
+                if id(index) not in written:
+                    written[id(index)] = f"{name}.npy"
+                    np.save(os.path.join(tmp_folder, f"{name}.npy"), np.asarray(index, dtype=np.float32))
+                files[name] = written[id(index)]
+            if region is not None:
+                np.save(os.path.join(tmp_folder, "region.npy"), np.asarray(region, dtype=bool))
+            with open(os.path.join(tmp_folder, "manifest.json"), "w", encoding="utf-8") as f:
+                saved_profile = None if profile is None else {
+                    "crs": profile["crs"].to_wkt() if profile.get("crs") else None,
+                    "transform": list(profile["transform"])[:6],
+                }
+                json.dump({"files": files, "stats": stats, "profile": saved_profile,
+                           "region": "region.npy" if region is not None else None,
+                           "version": index_definition_version()}, f)
+            os.rename(tmp_folder, folder)
+        except OSError:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            if not os.path.exists(folder):
+                raise
+        self.evict(keep=folder)
 
-        return ndvi, savi, vari, mndwi, ndmi_alt, cmr_alt, fmr_alt, evi, nbr, gci, tcari, bai, osavi
+    def evict(self, keep=None):
+        """Delete least recently used scenes until the store fits max_bytes."""
+        scenes = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name.endswith(".tmp"):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            scenes.append((entry.stat().st_mtime, size, entry.path))
+        total = sum(size for _, size, _ in scenes)
+        for _, size, path in sorted(scenes):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            # Open memory maps stay valid on POSIX after the files are removed
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
 
-    except Exception as e:
-        st.error(f"Error computing indices: {str(e)}")
-        return tuple([None] * 13)
 
-def format_analysis_summary(ndvi, savi, vari, mndwi, evi, nbr, gci, tcari, bai, osavi, moisture="high", valid_pixels=48.0):
-    """Format analysis results into a readable summary."""
+@st.cache_resource
+def get_index_store():
+    """Process-wide index store configured from the environment."""
+    return IndexStore(INDEX_STORE_DIR, INDEX_STORE_MAX_BYTES)
+
+
+# SQLite database with the per-index statistics of every scene of a field over time
+TIMESERIES_DB = os.getenv("AGRISAT_TIMESERIES_DB", "timeseries.sqlite")
+
+_TIMESERIES_STATS = (["mean", "std", "min", "max"]
+                     + [f"p{percent}" for percent in STATS_PERCENTILES] + ["valid_fraction"])
+
+
+class TimeSeriesStore:
+    """
+    Per-index statistics of each field by acquisition date, in SQLite. Scenes
+    are keyed by (field, date) and statistics by (field, date, index), so a
+    season's history is one indexed query. Recording a date again replaces it.
+    """
+
+    def __init__(self, path=TIMESERIES_DB):
+        self.path = path
+        columns = ", ".join(f"{stat} REAL" for stat in _TIMESERIES_STATS)
+        with closing(self._connect()) as db, db:
+            db.executescript(f"""
+                CREATE TABLE IF NOT EXISTS scenes (
+                    field TEXT NOT NULL, date TEXT NOT NULL, tile TEXT, scene_key TEXT NOT NULL,
+                    added TEXT NOT NULL, PRIMARY KEY (field, date));
+                CREATE INDEX IF NOT EXISTS scenes_by_key ON scenes (field, scene_key);
+                CREATE TABLE IF NOT EXISTS index_stats (
+                    field TEXT NOT NULL, date TEXT NOT NULL, index_name TEXT NOT NULL, {columns},
+                    PRIMARY KEY (field, date, index_name)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS index_stats_by_index ON index_stats (field, index_name, date);
+            """)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def has_scene(self, field, scene_key):
+        """Whether this scene (see analysis_key) was already recorded for the field."""
+        with closing(self._connect()) as db:
+            return db.execute("SELECT 1 FROM scenes WHERE field = ? AND scene_key = ?",
+                              (field, scene_key)).fetchone() is not None
+
+    def record(self, field, acquired, tile, scene_key, stats):
+        """Store a scene's statistics (see reduce_index_statistics) under its field and date."""
+        rows = [(field, acquired, name, *(index_stats.get(stat) for stat in _TIMESERIES_STATS))
+                for name, index_stats in stats["indices"].items()]
+        placeholders = ", ".join("?" * (3 + len(_TIMESERIES_STATS)))
+        with closing(self._connect()) as db, db:
+            db.execute("DELETE FROM index_stats WHERE field = ? AND date = ?", (field, acquired))
+            db.execute("INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?)",
+                       (field, acquired, tile, scene_key, datetime.now().isoformat(timespec="seconds")))
+            db.executemany(f"INSERT INTO index_stats VALUES ({placeholders})", rows)
+
+    def fields(self):
+        with closing(self._connect()) as db:
+            return [field for field, in db.execute("SELECT DISTINCT field FROM scenes ORDER BY field")]
+
+    def scenes(self, field):
+        """(date, tile, scene_key) of every recorded scene of a field, oldest first."""
+        with closing(self._connect()) as db:
+            return db.execute("SELECT date, tile, scene_key FROM scenes WHERE field = ? ORDER BY date",
+                              (field,)).fetchall()
+
+    def history(self, field, names, stat="mean"):
+        """{"date": [...], name: [...]} with one statistic of the given indices per recorded date."""
+        if stat not in _TIMESERIES_STATS:
+            raise ValueError(f"Unknown statistic {stat}")
+        dates = [acquired for acquired, _, _ in self.scenes(field)]
+        series = {"date": dates, **{name: [None] * len(dates) for name in names}}
+        position = {acquired: i for i, acquired in enumerate(dates)}
+        with closing(self._connect()) as db:
+            query = (f"SELECT date, index_name, {stat} FROM index_stats WHERE field = ? "
+                     f"AND index_name IN ({', '.join('?' * len(names))}) ORDER BY date")
+            for acquired, name, value in db.execute(query, (field, *names)):
+                series[name][position[acquired]] = value
+        return series
+
+
+@st.cache_resource
+def get_timeseries_store():
+    """Process-wide time-series store configured from the environment."""
+    return TimeSeriesStore(TIMESERIES_DB)
+
+
+# Indices the analysis summary cannot be written without
+SUMMARY_INDICES = ["NDVI", "SAVI", "VARI", "MNDWI", "EVI", "NBR", "GCI", "TCARI", "BAI", "OSAVI"]
+
+
+def has_summary_indices(stats):
+    """Whether stats (see reduce_index_statistics) has valid pixels in every index the summary needs."""
+    return all(stats["indices"].get(name, {}).get("count") for name in SUMMARY_INDICES)
+
+
+def format_analysis_summary(stats):
+    """
+    Format analysis results into a readable summary.
+    stats is the result of reduce_index_statistics for the scene.
+    """
     try:
         # Ensure all required indices are provided and calculated
-        indices = [ndvi, savi, vari, mndwi, evi, nbr, gci, tcari, bai, osavi]
-        if any(index is None for index in indices):
+        index_stats = stats["indices"]
+        if not has_summary_indices(stats):
             raise ValueError("Missing required index data")
 
-        # Calculate mean values for each index
-        ndvi_mean = np.nanmean(ndvi)
-        savi_mean = np.nanmean(savi)
-        vari_mean = np.nanmean(vari)
-        mndwi_mean = np.nanmean(mndwi)
-        evi_mean = np.nanmean(evi)
-        nbr_mean = np.nanmean(nbr)
-        gci_mean = np.nanmean(gci)
-        tcari_mean = np.nanmean(tcari)
-        bai_mean = np.nanmean(bai)
-        osavi_mean = np.nanmean(osavi)
+        # Mean values for each index
+        ndvi_mean = index_stats["NDVI"]["mean"]
+        savi_mean = index_stats["SAVI"]["mean"]
+        vari_mean = index_stats["VARI"]["mean"]
+        mndwi_mean = index_stats["MNDWI"]["mean"]
+        evi_mean = index_stats["EVI"]["mean"]
+        nbr_mean = index_stats["NBR"]["mean"]
+        gci_mean = index_stats["GCI"]["mean"]
+        tcari_mean = index_stats["TCARI"]["mean"]
+        bai_mean = index_stats["BAI"]["mean"]
+        osavi_mean = index_stats["OSAVI"]["mean"]
+
+        # Moisture needs the shortwave infrared band (B11); the NIR/red NDMI is NDVI by another name
+        ndmi = index_stats.get("NDMI_SWIR")
+        if ndmi is None or not ndmi["count"]:
+            moisture = "unknown (needs band B11)"
+        elif ndmi["mean"] > 0.2:
+            moisture = f"high (NDMI-SWIR {ndmi['mean']:.3f})"
+        elif ndmi["mean"] >= 0:
+            moisture = f"moderate (NDMI-SWIR {ndmi['mean']:.3f})"
+        else:
+            moisture = f"low (NDMI-SWIR {ndmi['mean']:.3f})"
+        valid_pixels = round(100 * stats["valid_fraction"], 1)
 
         # Assessments for readability
         vegetation_status = "good" if ndvi_mean > 0.3 else "poor"
@@ -249,35 +2048,461 @@ SATELLITE ANALYSIS SUMMARY:
         return f"Error formatting analysis summary: {str(e)}"
 
 
-def plot_index_with_interpretation(index, title, cmap="RdYlGn", vmin=-1, vmax=1):
-    """Plot the selected index with appropriate coloring and title and return it as HTML."""
+def analyse_scene(source, scene_key=None, boundary=None, decimation=1, resolution=None):
+    """
+    Load a scene and compute its indices, statistics and summary. Full resolution
+    results are saved to the index store under scene_key and reloaded memory-mapped.
+    Returns {"indices", "stats", "summary"} or None if nothing could be computed.
+    """
+    bands = load_bands_and_compute_indices(source, boundary, decimation, resolution)
+    if bands is None:
+        return None
+
+    # Compute all indices the uploaded bands allow
+    indices = compute_indices(bands)
+    region, profile = bands.region, bands.profile
+    del bands
+    if all(index is None for index in indices):
+        return None
+
+    # One pass over every index feeds the summary and the metrics panel
+    stats = reduce_index_statistics(dict(zip(INDEX_SHORT_NAMES, indices)), region=region)
+
+    if scene_key is not None and decimation == 1:
+        # Keep the memory-mapped copy so sessions share one in the page cache
+        store = get_index_store()
+        try:
+            store.save(scene_key, dict(zip(INDEX_SHORT_NAMES, indices)), stats, profile, region)
+            stored_indices, _ = store.load(scene_key)
+            indices = tuple(stored_indices.get(name) for name in INDEX_SHORT_NAMES)
+        except (OSError, TypeError) as e:
+            report("warning", f"Could not save indices to the shared store: {str(e)}")
+
+    return {"indices": indices, "stats": stats, "summary": format_analysis_summary(stats),
+            "region": region, "profile": profile}
+
+
+def analyse_scene_windowed(source, boundary=None, resolution=None):
+    """
+    analyse_scene for scenes too large to hold in memory: the statistics and
+    summary are computed at full resolution block by block (see
+    compute_indices_windowed), the indices only at 1/QUICKLOOK_DECIMATION
+    resolution for display. Nothing is saved to the index store. The result is
+    marked "preview"; None if nothing could be computed.
+    """
+    scene = analyse_scene(source, boundary=boundary, decimation=QUICKLOOK_DECIMATION, resolution=resolution)
+    if scene is None:
+        return None
+    names = [name for name, index in zip(INDEX_SHORT_NAMES, scene["indices"]) if index is not None]
     try:
-        fig, ax = plt.subplots(figsize=(10, 14))
-        ep.plot_bands(index, cmap=cmap, cols=1, vmin=vmin, vmax=vmax, ax=ax)
-        plt.title(title)
-        
-        # Save plot to a temporary buffer
-        buf = BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight', dpi=300)
-        plt.close()
-        buf.seek(0)
-        
-        # Encode the image as base64
-        image_base64 = base64.b64encode(buf.getvalue()).decode()
-        
-        # Create HTML for the image with a button to open in new tab
+        stats = compute_indices_windowed(source, names=names, boundary=boundary, resolution=resolution)
+    except Exception as e:
+        report("error", f"Error computing full resolution statistics: {str(e)}")
+        return None
+    del stats["height"], stats["width"], stats["bands"]
+    scene.update(stats=stats, summary=format_analysis_summary(stats), preview=True)
+    return scene
+
+
+def estimate_analysis_bytes(source, boundary=None, resolution=None, decimation=1, block_pixels=None):
+    """
+    Rough peak memory of analyse_scene from the band headers alone: the bands the
+    indices read in their stored data type with their validity masks, plus the
+    float32 indices and a few scratch arrays. With block_pixels, the same for one
+    block of compute_indices_windowed. Returns 0 when the headers cannot be read
+    (the analysis itself then reports why).
+    """
+    try:
+        with open_scene(source) as (sentinel_bands, open_band):
+            band_files, _ = map_band_files(sentinel_bands)
+            band_files = index_band_files(band_files)
+            if not band_files:
+                return 0
+            headers = [_band_header(open_band, band_file) for band_file in band_files.values()]
+            grid = target_grid(headers, boundary, resolution, decimation)
+    except Exception:
+        return 0
+    pixels = grid["height"] * grid["width"]
+    if block_pixels:
+        pixels = min(pixels, block_pixels)
+    band_bytes = sum(np.dtype(header["dtype"]).itemsize + 1 for header in headers)
+    return pixels * (band_bytes + 4 * (len(INDEX_SHORT_NAMES) + 4))
+
+
+# Uploads of at least this size first get a quick look at 1/QUICKLOOK_DECIMATION
+# resolution while the full resolution analysis waits for and runs on the job queue
+QUICKLOOK_MIN_BYTES = int(os.getenv("AGRISAT_QUICKLOOK_BYTES", 64 * 1024 ** 2))
+QUICKLOOK_DECIMATION = int(os.getenv("AGRISAT_QUICKLOOK_DECIMATION", 8))
+
+# Scene analyses running at once, and the estimated memory they may use together
+JOB_WORKERS = int(os.getenv("AGRISAT_JOB_WORKERS", 2))
+JOB_MEMORY_BYTES = int(os.getenv("AGRISAT_JOB_MEMORY_BYTES", 4 * 1024 ** 3))
+
+# Seconds the page waits for a small scene before showing the queue status instead
+JOB_INLINE_WAIT_SECONDS = 3
+
+# Finished jobs remembered so sessions can pick up their results
+JOB_HISTORY = 64
+
+
+class _ThreadMessages(logging.Handler):
+    """Keeps the warnings and errors reported by one thread."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.thread = threading.get_ident()
+        self.messages = []
+
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.messages.append((record.levelname.lower(), record.getMessage()))
+
+
+class AnalysisJob:
+    """
+    One queued scene analysis. status is queued, running, done, failed or
+    rejected; messages holds the (level, message) pairs reported while it ran.
+    """
+
+    def __init__(self, job_id, key, function, args, memory):
+        self.job_id = job_id
+        self.key = key
+        self.function = function
+        self.args = args
+        self.memory = memory
+        self.status = "queued"
+        self.result = None
+        self.messages = []
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the job has finished or timeout seconds passed; returns done()."""
+        return self._done.wait(timeout)
+
+
+class JobManager:
+    """
+    Runs scene analyses on a bounded number of worker threads. Jobs start in
+    submission order once a worker is free and their estimated memory fits in
+    the budget next to the running jobs; a job larger than the whole budget is
+    rejected instead of risking the server. Identical analyses submitted by
+    several sessions share one job.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, memory_budget=JOB_MEMORY_BYTES):
+        self.memory_budget = memory_budget
+        self._condition = threading.Condition()
+        self._queue = deque()
+        self._jobs = {}
+        self._by_key = {}
+        self._finished = deque()
+        self._running = 0
+        self._memory_in_use = 0
+        for number in range(max(1, workers)):
+            threading.Thread(target=self._work, name=f"analysis-worker-{number}", daemon=True).start()
+
+    def submit(self, key, function, *args, memory=0):
+        """Queue function(*args) under key, or return the job already queued or running for key."""
+        with self._condition:
+            job = self._by_key.get(key)
+            if job is not None and not job.done():
+                return job
+            job = AnalysisJob(uuid.uuid4().hex, key, function, args, memory)
+            self._jobs[job.job_id] = job
+            self._by_key[key] = job
+            if memory > self.memory_budget:
+                job.status = "rejected"
+                job.messages.append(("error", f"This analysis needs about {memory / 1024 ** 3:.1f} GB, more than "
+                                              f"the server allows ({self.memory_budget / 1024 ** 3:.1f} GB). "
+                                              "Choose a coarser resolution or a field boundary."))
+                self._finish(job)
+            else:
+                self._queue.append(job)
+                self._condition.notify_all()
+        return job
+
+    def get(self, job_id):
+        """The job with this ID, or None if it is unknown or long finished."""
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def position(self, job):
+        """1-based place of a queued job in the queue; 0 once it is running or finished."""
+        with self._condition:
+            try:
+                return self._queue.index(job) + 1
+            except ValueError:
+                return 0
+
+    def stats(self):
+        with self._condition:
+            return {"queued": len(self._queue), "running": self._running,
+                    "memory_in_use": self._memory_in_use, "memory_budget": self.memory_budget}
+
+    def _admissible(self):
+        """The head of the queue if it may start now (strict order, so large jobs are not starved)."""
+        if not self._queue:
+            return None
+        job = self._queue[0]
+        if self._running and self._memory_in_use + job.memory > self.memory_budget:
+            return None
+        return job
+
+    def _finish(self, job):
+        """Mark a job finished and forget the oldest finished jobs (call with the lock held)."""
+        job.finished = time.time()
+        job._done.set()
+        self._finished.append(job)
+        while len(self._finished) > JOB_HISTORY:
+            old = self._finished.popleft()
+            self._jobs.pop(old.job_id, None)
+            if self._by_key.get(old.key) is old:
+                del self._by_key[old.key]
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._admissible()
+                while job is None:
+                    self._condition.wait()
+                    job = self._admissible()
+                self._queue.popleft()
+                self._running += 1
+                self._memory_in_use += job.memory
+                job.status = "running"
+                job.started = time.time()
+
+            collector = _ThreadMessages()
+            logger.addHandler(collector)
+            try:
+                job.result = job.function(*job.args)
+                job.status = "done" if job.result is not None else "failed"
+            except Exception as e:
+                collector.messages.append(("error", f"An error occurred: {str(e)}"))
+                job.status = "failed"
+            finally:
+                logger.removeHandler(collector)
+                job.messages.extend(collector.messages)
+                # Drop the inputs (the uploaded bytes) as soon as the job is over
+                job.args = ()
+                with self._condition:
+                    self._running -= 1
+                    self._memory_in_use -= job.memory
+                    self._finish(job)
+                    self._condition.notify_all()
+
+
+@st.cache_resource
+def get_job_manager():
+    """The job queue shared by every session and rerun."""
+    return JobManager()
+
+
+def session_job(scene_key):
+    """The job this session submitted for scene_key and has not taken the result of yet, or None."""
+    session_jobs = st.session_state.get("analysis_jobs", {})
+    job = get_job_manager().get(session_jobs.get(scene_key))
+    if job is None:
+        # Forgotten by the manager (finished long ago): nothing left to report
+        session_jobs.pop(scene_key, None)
+    return job
+
+
+def submit_analysis(uploaded_file, scene_key, boundary=None, resolution=None):
+    """Queue the analysis of an upload for this session, or return the job this session already has for it."""
+    manager = get_job_manager()
+    session_jobs = st.session_state.setdefault("analysis_jobs", {})
+    job = manager.get(session_jobs.get(scene_key))
+    if job is None:
+        data = uploaded_file.getvalue()
+        memory = estimate_analysis_bytes(data, boundary, resolution)
+        if memory <= manager.memory_budget:
+            job = manager.submit(scene_key, analyse_scene, data, scene_key, boundary, 1, resolution, memory=memory)
+        else:
+            # Too large for memory: full resolution statistics block by block next to a quick look
+            memory = (estimate_analysis_bytes(data, boundary, resolution, QUICKLOOK_DECIMATION)
+                      + estimate_analysis_bytes(data, boundary, resolution, block_pixels=DEFAULT_BLOCK_PIXELS))
+            job = manager.submit(scene_key, analyse_scene_windowed, data, boundary, resolution, memory=memory)
+        session_jobs[scene_key] = job.job_id
+    return job
+
+
+def take_analysis_result(job, scene_key):
+    """Show what a finished job reported and return its scene (None if it failed)."""
+    st.session_state.get("analysis_jobs", {}).pop(scene_key, None)
+    for level, message in job.messages:
+        (st.error if level in ("error", "critical") else st.warning)(message)
+    return job.result
+
+
+@st.fragment(run_every=1)
+def show_job_progress(job):
+    """Queue position or running time of a job; reruns the page once it has finished."""
+    if job.done():
+        st.rerun()
+    position = get_job_manager().position(job)
+    if position:
+        st.info(f"Waiting for a free worker: position {position} in the queue.")
+    else:
+        st.info(f"Analysing the full resolution scene ({time.time() - job.started:.0f}s)...")
+
+
+# Rows written per window when exporting GeoTIFFs
+EXPORT_BLOCK_ROWS = 512
+
+
+@contextmanager
+def cog_writer(path, names, height, width, profile=None):
+    """
+    Yield a dataset to write one float32 band per name into, window by window,
+    with the georeferencing in profile (crs, transform). It is a temporary tiled
+    GeoTIFF (fast zstd) which GDAL copies to path on exit as a cloud-optimized
+    GeoTIFF: 512 px internal tiles, deflate compression and averaged overviews.
+    """
+    import rasterio as rio
+    from rasterio.shutil import copy as rio_copy
+
+    profile = profile or {}
+    with instrument_stage("export"), \
+            tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp_dir:
+        staging_path = os.path.join(tmp_dir, "staging.tif")
+        with rio.open(staging_path, "w", driver="GTiff", height=height, width=width, count=len(names),
+                      dtype="float32", crs=profile.get("crs"), transform=profile.get("transform"),
+                      nodata=np.nan, tiled=True, blockxsize=512, blockysize=512,
+                      compress="zstd", zstd_level=1, BIGTIFF="IF_SAFER") as dst:
+            for band, name in enumerate(names, start=1):
+                dst.set_band_description(band, name)
+            yield dst
+
+        # Deflate is read by every GIS; level 1 is much faster at nearly the same size
+        rio_copy(staging_path, path, driver="COG", compress="deflate", level=1, predictor=3, blocksize=512,
+                 overview_resampling="average", num_threads="all_cpus", bigtiff="if_safer")
+
+
+def write_indices_cog(indices, profile, path, names=None, block_rows=EXPORT_BLOCK_ROWS):
+    """
+    Write indices (dict of name to array; all by default or those in names) as
+    one multi-band cloud-optimized GeoTIFF at path (see cog_writer), window by
+    window so memory stays bounded for memory-mapped indices. Returns the names
+    of the bands written.
+    """
+    from rasterio.windows import Window
+
+    names = [name for name in (names or INDEX_SHORT_NAMES) if indices.get(name) is not None]
+    if not names:
+        raise ValueError("No computed indices to export")
+    height, width = indices[names[0]].shape
+
+    with cog_writer(path, names, height, width, profile) as dst:
+        for row in range(0, height, block_rows):
+            window = Window(0, row, width, min(block_rows, height - row))
+            for band, name in enumerate(names, start=1):
+                dst.write(np.asarray(indices[name][row:row + window.height], dtype=np.float32), band,
+                          window=window)
+    return names
+
+
+# Longest side (pixels) of the index image shown on the page
+PREVIEW_MAX_PIXELS = 1200
+
+# Memory budget (bytes) for rendered PNGs kept between reruns
+RENDER_CACHE_BYTES = int(os.getenv("AGRISAT_RENDER_CACHE_BYTES", 128 * 1024 ** 2))
+
+
+@st.cache_resource
+def get_render_cache():
+    """Process-wide cache of rendered index images keyed by (scene, index, size)."""
+    return ResultCache(RENDER_CACHE_BYTES)
+
+
+@lru_cache(maxsize=32)
+def colormap_lut(cmap):
+    """256-entry RGBA uint8 lookup table for a matplotlib colormap."""
+    import matplotlib
+    return matplotlib.colormaps[cmap](np.linspace(0.0, 1.0, 256), bytes=True)
+
+
+def colorize_index(index, cmap="RdYlGn", vmin=-1, vmax=1):
+    """
+    Map an index array to RGBA pixels through a uint8 lookup table.
+    Values are clipped to [vmin, vmax]; NaN pixels become transparent.
+    """
+    index = np.asarray(index, dtype=np.float32)
+    invalid = ~np.isfinite(index)
+    scaled = np.subtract(index, vmin, dtype=np.float32)
+    scaled *= 255.0 / (vmax - vmin)
+    scaled[invalid] = 0
+    np.clip(scaled, 0, 255, out=scaled)
+    rgba = colormap_lut(cmap)[scaled.astype(np.uint8)]
+    rgba[invalid] = 0
+    return rgba
+
+
+def render_index_png(index, cmap="RdYlGn", vmin=-1, vmax=1, max_pixels=PREVIEW_MAX_PIXELS):
+    """
+    Render an index as PNG bytes. The array is decimated so its longest side
+    fits max_pixels (None keeps full resolution) before colouring.
+    """
+    if max_pixels:
+        step = max(1, int(np.ceil(max(index.shape) / max_pixels)))
+        index = index[::step, ::step]
+    from matplotlib import image as mpimg
+    buf = BytesIO()
+    mpimg.imsave(buf, colorize_index(index, cmap, vmin, vmax), format="png")
+    return buf.getvalue()
+
+
+def _cached_index_png(index, title, cmap, vmin, vmax, max_pixels, scene_key):
+    """Render through the render cache when the scene is known."""
+    if scene_key is None:
+        return render_index_png(index, cmap, vmin, vmax, max_pixels)
+    cache = get_render_cache()
+    key = (scene_key, title, cmap, vmin, vmax, max_pixels)
+    png = cache.get(key)
+    if png is None:
+        png = render_index_png(index, cmap, vmin, vmax, max_pixels)
+        cache.put(key, png)
+    return png
+
+
+def plot_index_with_interpretation(index, title, cmap="RdYlGn", vmin=-1, vmax=1, scene_key=None):
+    """
+    Show the selected index as a colour-mapped image with a colour scale.
+    The on-page image is downsampled to fit the viewport; the full-resolution
+    PNG is only rendered when the user asks to download it.
+    """
+    try:
+        with instrument_stage("render"):
+            png = _cached_index_png(index, title, cmap, vmin, vmax, PREVIEW_MAX_PIXELS, scene_key)
+        image_base64 = base64.b64encode(png).decode()
+
+        # Colour scale drawn as a CSS gradient from the same lookup table
+        stops = ", ".join(f"rgb({r},{g},{b})" for r, g, b, _ in colormap_lut(cmap)[::25])
         html = f'''
             <div style="text-align: center;">
-                <img src="data:image/png;base64,{image_base64}" style="max-width: 100%; height: auto;">
-                <br>
-                <a href="data:image/png;base64,{image_base64}" target="_blank">
-                    <button style="margin-top: 10px; padding: 10px; background-color: #4CAF50; color: white; border: none; border-radius: 5px; cursor: pointer;">
-                        Open Plot in New Tab
-                    </button>
-                </a>
+                <img src="data:image/png;base64,{image_base64}" style="max-width: 100%; height: auto;" alt="{title}">
+                <div style="margin: 8px auto 0; max-width: 480px; height: 12px; background: linear-gradient(to right, {stops});"></div>
+                <div style="margin: 0 auto; max-width: 480px; display: flex; justify-content: space-between; font-size: 0.8em;">
+                    <span>{vmin}</span><span>{title.split(" ")[0]}</span><span>{vmax}</span>
+                </div>
             </div>
         '''
         st.markdown(html, unsafe_allow_html=True)
+
+        if st.button("Prepare full-resolution image", key=f"full_res_{title}"):
+            full_png = _cached_index_png(index, title, cmap, vmin, vmax, None, scene_key)
+            st.download_button(
+                "Download full-resolution PNG",
+                data=full_png,
+                file_name=f"{title.split(' ')[0]}.png",
+                mime="image/png",
+            )
         
     except Exception as e:
         st.error(f"Error plotting index: {str(e)}")
@@ -339,6 +2564,16 @@ def get_index_interpretation(index_name):
         
         NDMI is particularly useful for monitoring drought conditions and irrigation needs.
         """,
+
+        "NDMI-SWIR (Moisture Index from Shortwave Infrared)": """
+        - Range: -1 to 1
+        - Used for: Leaf and canopy water content, from NIR (B08) and shortwave infrared (B11)
+        - < 0: Water stress or low moisture content
+        - 0-0.2: Moderate moisture content
+        - > 0.2: High moisture content
+
+        Only shown when band B11 is uploaded. This is the moisture reading used in the analysis summary.
+        """,
         
         "CMR (Chlorophyll/Moisture Ratio)": """
         - Used for: Assessing both chlorophyll content and moisture stress
@@ -419,6 +2654,174 @@ def get_index_interpretation(index_name):
     """)
 
 
+def zone_table_csv(table):
+    """CSV text of a zone table."""
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(table)
+    writer.writerows(zip(*(values.tolist() for values in table.values())))
+    return output.getvalue()
+
+
+def show_management_zones(scene, scene_key, name, title):
+    """Zone statistics over a configurable grid: a zone map of the index and a zone table."""
+    st.write("### Management Zones")
+    cell_pixels = st.number_input(
+        "Zone size (pixels per side)", min_value=2, max_value=1000, value=ZONE_CELL_PIXELS, step=5,
+        help="Each square zone of this many pixels gets its own statistics, e.g. 20 pixels = 200 m at 10 m resolution"
+    )
+    # Zones of each size are computed once per scene and kept with it
+    zones_by_size = scene.setdefault("zones", {})
+    zones = zones_by_size.get(cell_pixels)
+    if zones is None:
+        zones = zonal_statistics(dict(zip(INDEX_SHORT_NAMES, scene["indices"])), cell_pixels,
+                                 region=scene.get("region"))
+        zones_by_size[cell_pixels] = zones
+
+    # One pixel per zone, enlarged so small grids stay visible
+    zone_means = zone_map(zones, name)
+    scale = max(1, min(cell_pixels, PREVIEW_MAX_PIXELS // max(zone_means.shape)))
+    plot_index_with_interpretation(np.kron(zone_means, np.ones((scale, scale), dtype=np.float32)),
+                                   f"{title} zone means", scene_key=f"{scene_key}-zones{cell_pixels}")
+
+    table = zone_table(zones)
+    st.dataframe({column: values for column, values in table.items()
+                  if column in ("zone", "row", "col", "pixels") or column.startswith(f"{name}_")},
+                 hide_index=True)
+    st.download_button("Download zone table (all indices)", data=zone_table_csv(table),
+                       file_name=f"zones_{cell_pixels}px.csv", mime="text/csv")
+
+
+def show_index_export(scene, scene_key):
+    """Download of any computed indices as one multi-band cloud-optimized GeoTIFF."""
+    st.header("Export")
+    indices = {name: index for name, index in zip(INDEX_SHORT_NAMES, scene["indices"]) if index is not None}
+    names = st.multiselect("Indices to export", list(indices), default=list(indices)[:1],
+                           help="Each index becomes one band of a tiled, compressed GeoTIFF with overviews")
+    if names and st.button("Prepare GeoTIFF"):
+        # The file is written block by block to disk; Streamlit then keeps one copy of it for the download
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "indices.tif")
+            try:
+                write_indices_cog(indices, scene.get("profile"), path, names)
+            except Exception as e:
+                st.error(f"Error exporting indices: {str(e)}")
+                return
+            with open(path, "rb") as f:
+                st.download_button("Download GeoTIFF", data=f, file_name=f"{'_'.join(names)}.tif",
+                                   mime="image/tiff")
+
+
+def same_grid(profile, other):
+    """Whether two georeferencing profiles (crs, transform) put pixels at the same places; False if unknown."""
+    if not profile or not other or profile["crs"] is None or profile["crs"] != other["crs"]:
+        return False
+    return profile["transform"].almost_equals(other["transform"], precision=1e-9)
+
+
+# Indices charted over time, and the change map's colour scale
+TIMESERIES_INDICES = ["NDVI", "EVI"]
+CHANGE_MAP_RANGE = 0.5
+
+
+def show_time_series(boundary=None, resolution=None):
+    """
+    Time-series mode: record every new scene of a field in the time-series
+    store, then chart the indices over time and map the change since the
+    previous date. Scenes already recorded are not processed again.
+    """
+    st.header("Field History")
+    store = get_timeseries_store()
+    known_fields = store.fields()
+    field = st.text_input("Field name", value=known_fields[0] if known_fields else "",
+                          help=f"Scenes of the same field are tracked together. Known fields: "
+                               f"{', '.join(known_fields) or 'none yet'}")
+    uploaded_files = st.file_uploader("Upload scene zips of this field (any number, in any order)",
+                                      type="zip", accept_multiple_files=True)
+    if not field:
+        st.write("Enter a field name to record and view its history.")
+        return
+
+    for uploaded_file in uploaded_files or []:
+        scene_key = analysis_key(uploaded_scene_digest(uploaded_file), boundary, resolution)
+        if store.has_scene(field, scene_key):
+            continue
+        acquired, tile = scene_acquisition(uploaded_file.getvalue())
+        if acquired is None:
+            st.warning(f"{uploaded_file.name}: no acquisition date in the band file names, skipped")
+            continue
+        stored = get_index_store().load(scene_key) if session_job(scene_key) is None else None
+        if stored is not None and stored[1] is not None:
+            stats = stored[1]
+        else:
+            job = submit_analysis(uploaded_file, scene_key, boundary, resolution)
+            with st.spinner(f"Analysing {uploaded_file.name} ({acquired})..."):
+                job.wait()
+            scene = take_analysis_result(job, scene_key)
+            if scene is None:
+                continue
+            stats = scene["stats"]
+        store.record(field, acquired, tile, scene_key, stats)
+
+    scenes = store.scenes(field)
+    if not scenes:
+        st.write("No scenes recorded for this field yet.")
+        return
+
+    st.subheader("Trends")
+    history = store.history(field, TIMESERIES_INDICES)
+    st.line_chart(history, x="date", y=TIMESERIES_INDICES)
+    st.caption(f"{len(scenes)} scenes from {scenes[0][0]} to {scenes[-1][0]}")
+
+    if len(scenes) < 2:
+        return
+    st.subheader("Change Since the Previous Scene")
+    name = st.selectbox("Index", TIMESERIES_INDICES)
+    (previous_date, _, previous_key), (latest_date, _, latest_key) = scenes[-2], scenes[-1]
+    previous, latest = get_index_store().load(previous_key), get_index_store().load(latest_key)
+    if previous is None or latest is None:
+        st.write("The index rasters of these dates are no longer stored; upload both scenes again to map the change.")
+        return
+    before, after = previous[0].get(name), latest[0].get(name)
+    before_grid, after_grid = get_index_store().profile(previous_key), get_index_store().profile(latest_key)
+    if (before is None or after is None or before.shape != after.shape
+            or not same_grid(before_grid, after_grid)):
+        st.write("The two scenes do not cover the same grid, so they cannot be compared pixel by pixel.")
+        return
+    plot_index_with_interpretation(after - before, f"{name} change {previous_date} to {latest_date}",
+                                   cmap="RdBu", vmin=-CHANGE_MAP_RANGE, vmax=CHANGE_MAP_RANGE,
+                                   scene_key=f"{previous_key}-{latest_key}")
+
+
+def field_boundary_input():
+    """
+    Sidebar controls for limiting the analysis to one field. Returns the field
+    geometries (see parse_field_boundary) or None to analyse the whole scene.
+    """
+    st.sidebar.header("Field Boundary")
+    boundary_file = st.sidebar.file_uploader("Field boundary (GeoJSON, WGS84)", type=["geojson", "json"])
+    bbox_text = st.sidebar.text_input("Or bounding box", placeholder="min lon, min lat, max lon, max lat")
+    try:
+        if boundary_file is not None:
+            return parse_field_boundary(geojson=boundary_file.getvalue())
+        if bbox_text.strip():
+            return parse_field_boundary(bbox=bbox_text.split(","))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        st.sidebar.error(f"Invalid field boundary, analysing the whole scene: {str(e)}")
+    return None
+
+
+def resolution_input():
+    """Sidebar choice of the grid bands are resampled to; None keeps the finest band's grid."""
+    labels = {"Native (finest band)": None, **{f"{metres} m": metres for metres in TARGET_RESOLUTIONS}}
+    choice = st.sidebar.selectbox(
+        "Analysis resolution", list(labels),
+        help="Bands of other resolutions are resampled to this grid while reading. "
+             "20 m needs about a quarter of the memory and time of 10 m."
+    )
+    return labels[choice]
+
+
 def main():
     """Main application function."""
     st.set_page_config(page_title="Agricultural Satellite Analysis", layout="wide")
@@ -426,116 +2829,156 @@ def main():
     st.title("Advanced Satellite Analysis for Agricultural Insights")
     st.write("Upload satellite data to analyze vegetation indices and get agricultural insights")
 
+    mode = st.sidebar.radio("Mode", ["Single scene", "Time series"],
+                            help="Time series tracks one field across many scenes")
+    boundary = field_boundary_input()
+    resolution = resolution_input()
+    if mode == "Time series":
+        show_time_series(boundary, resolution)
+        show_instrumentation_panel()
+        return
+
     uploaded_file = st.file_uploader("Upload a zip file containing satellite data", type="zip")
     
     if uploaded_file:
         try:
-            with zipfile.ZipFile(uploaded_file, 'r') as zip_ref:
-                data_folder = "extracted_data"
-                if os.path.exists(data_folder):
-                    for file in glob(os.path.join(data_folder, "*")):
-                        os.remove(file)
+            cache = get_result_cache()
+            with instrument_stage("ingest") as stage:
+                scene_key = uploaded_scene_digest(uploaded_file)
+                stage.add_bytes(uploaded_file.size)
+            # Results for a field or another resolution are cached apart from the whole scene's
+            scene_key = analysis_key(scene_key, boundary, resolution)
+            scene = cache.get(scene_key)
+            job = None
+
+            if scene is None:
+                # This session's own job comes first so its warnings are shown when it finishes;
+                # otherwise another session or batch job may already have computed this scene
+                job = session_job(scene_key)
+                stored = None if job is not None else get_index_store().load(scene_key)
+                if stored is not None and stored[1] is not None:
+                    stored_indices, stats = stored
+                    scene = {"indices": tuple(stored_indices.get(name) for name in INDEX_SHORT_NAMES),
+                             "stats": stats, "summary": format_analysis_summary(stats),
+                             "profile": get_index_store().profile(scene_key),
+                             "region": get_index_store().region(scene_key)}
                 else:
-                    os.makedirs(data_folder)
-                zip_ref.extractall(data_folder)
+                    # Scenes are analysed on the shared job queue, not in this script thread
+                    job = submit_analysis(uploaded_file, scene_key, boundary, resolution)
+                    if uploaded_file.size < QUICKLOOK_MIN_BYTES:
+                        job.wait(JOB_INLINE_WAIT_SECONDS)
+                    if job.done():
+                        scene = take_analysis_result(job, scene_key)
+                        job = None
+                        if scene is None:
+                            return
+                    elif uploaded_file.size < QUICKLOOK_MIN_BYTES:
+                        show_job_progress(job)
+                        return
+                    else:
+                        # Show a decimated quick look until the full resolution job has finished
+                        preview_key = f"{scene_key}-quicklook"
+                        scene = cache.get(preview_key)
+                        if scene is None:
+                            scene = analyse_scene(uploaded_file.getvalue(), boundary=boundary,
+                                                  decimation=QUICKLOOK_DECIMATION, resolution=resolution)
+                            if scene is None:
+                                return
+                            cache.put(preview_key, scene)
+                        scene_key = preview_key
 
-            st.write("Processing satellite data...")
-            arr_st = load_bands_and_compute_indices(data_folder)
-            
-            if arr_st is not None:
-                # Compute all indices
-                indices = compute_indices(arr_st)
-                
-                # Updated index names with descriptions
-                index_names = [
-                    "NDVI (Normalized Difference Vegetation Index)",
-                    "SAVI (Soil Adjusted Vegetation Index)",
-                    "VARI (Visible Atmospherically Resistant Index)",
-                    "MNDWI (Modified Normalized Difference Water Index)",
-                    "NDMI (Normalized Difference Moisture Index)",
-                    "CMR (Chlorophyll/Moisture Ratio)",
-                    "FMR (Floating Mat Recognition)",
-                    "EVI (Enhanced Vegetation Index)",
-                    "NBR (Normalized Burn Ratio)",
-                    "GCI (Green Chlorophyll Index)",
-                    "TCARI (Transformed Chlorophyll Absorption in Reflectance Index)",
-                    "BAI (Burn Area Index)",
-                    "OSAVI (Optimized Soil-Adjusted Vegetation Index)"
-                ]
-                
-                # Visualization section
-                st.header("Visualization Tools")
-                
-                # Index selection with improved dropdown
-                selected_index = st.selectbox(
-                    "Select an index to visualize",
-                    index_names,
-                    help="Choose which vegetation index to display"
-                )
-                
-                # Get index data (map full names to short names for data access)
-                short_names = ["NDVI", "SAVI", "VARI", "MNDWI", "NDMI", "CMR", "FMR", 
-                             "EVI", "NBR", "GCI", "TCARI", "BAI", "OSAVI"]
-                index_dict = dict(zip(index_names, indices))
-                selected_data = index_dict[selected_index]
-                
-                if selected_data is not None:
-                    # Display plot and interpretation
-                    st.subheader(f"{selected_index} Visualization")
-                    plot_index_with_interpretation(selected_data, selected_index)
-                    
-                    # Show interpretation
-                    st.write("### How to Interpret This Index")
-                    interpretation = get_index_interpretation(selected_index)
-                    st.markdown(interpretation)
-                    
-                    # Statistics for selected index
-                    st.write("### Statistical Analysis")
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        st.metric("Mean Value", f"{np.nanmean(selected_data):.3f}")
-                    with col2:
-                        st.metric("Min Value", f"{np.nanmin(selected_data):.3f}")
-                    with col3:
-                        st.metric("Max Value", f"{np.nanmax(selected_data):.3f}")
-                    
-                    # Generate comprehensive analysis
-                analysis_summary = format_analysis_summary(
-                                        indices[0],  # NAVI 
-                                        indices[1],  # SAVI
-                                        indices[2],  # VARI
-                                        indices[3],  # MNDWI
-                                        indices[4],  # EVI
-                                        indices[5],  # NBR
-                                        indices[6],  # GCI
-                                        indices[7],  # TCARI
-                                        indices[8],  # BAI
-                                        indices[9]   # OSAVI
-                                        )
-                
-                print(analysis_summary)
-                    
-                    # Get insights from Groq
+                if job is None:
+                    print(scene["summary"])
+                    cache.put(scene_key, scene)
+
+            indices = scene["indices"]
+
+            if job is not None:
+                st.info(f"Quick look at 1/{QUICKLOOK_DECIMATION} resolution. "
+                        "The full resolution results replace it automatically.")
+                show_job_progress(job)
+                insights = "Insights are generated once the full resolution analysis is ready."
+            else:
+                # Start generating insights in the background while the plots render
+                try:
+                    insights = start_farmer_insights(scene["summary"])
+                except Exception as e:
+                    insights = f"Error generating insights: {str(e)}"
+
+            index_names = [INDEX_REGISTRY[name]["title"]
+                           for name, index in zip(INDEX_SHORT_NAMES, indices) if index is not None]
+
+            # Visualization section
+            st.header("Visualization Tools")
+
+            # Index selection with improved dropdown
+            selected_index = st.selectbox(
+                "Select an index to visualize",
+                index_names,
+                help="Choose which vegetation index to display"
+            )
+
+            short_names = {INDEX_REGISTRY[name]["title"]: name for name in INDEX_SHORT_NAMES}
+            selected_name = short_names[selected_index]
+            selected_data = dict(zip(INDEX_SHORT_NAMES, indices))[selected_name]
+
+            if selected_data is not None:
+                # Display plot and interpretation
+                st.subheader(f"{selected_index} Visualization")
+                plot_index_with_interpretation(selected_data, selected_index, scene_key=scene_key)
+
+                # Show interpretation
+                st.write("### How to Interpret This Index")
+                interpretation = get_index_interpretation(selected_index)
+                st.markdown(interpretation)
+
+                # Statistics for selected index
+                st.write("### Statistical Analysis")
+                selected_stats = scene["stats"]["indices"][selected_name]
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("Mean Value", f"{selected_stats['mean']:.3f}")
+                    st.metric("Standard Deviation", f"{selected_stats['std']:.3f}")
+                with col2:
+                    st.metric("Min Value", f"{selected_stats['min']:.3f}")
+                    median = selected_stats["p50"]
+                    st.metric("Median", f"{median:.3f}" if np.isfinite(median) else "beyond range")
+                with col3:
+                    st.metric("Max Value", f"{selected_stats['max']:.3f}")
+                    st.metric("Valid Pixels", f"{100 * selected_stats['valid_fraction']:.1f}%")
+
+                if not scene.get("preview"):
+                    show_management_zones(scene, scene_key, selected_name, selected_index)
+
+            if scene.get("preview"):
+                st.info(f"This scene is too large to analyse in memory: the statistics are at full "
+                        f"resolution, the maps at 1/{QUICKLOOK_DECIMATION} resolution. Choose a coarser "
+                        "resolution or a field boundary for zones and export, or run batch.py --export-cog.")
+            elif job is None:
+                # Quick looks are not exported; their full resolution replacement is
+                show_index_export(scene, scene_key)
+
+            # Insights stream in as they are generated (or come from the disk cache)
             st.header("AI-Powered Agricultural Insights")
-            insights = get_farmer_insights(analysis_summary)
-            st.write(insights)
-            
-            # Cleanup
-            for file in glob(os.path.join(data_folder, "*")):
-                os.remove(file)
-            if os.path.exists(data_folder):
-                os.rmdir(data_folder)
-                
+            if isinstance(insights, str):
+                st.write(insights)
+            else:
+                st.write_stream(insights.stream())
+
+            cache_stats = cache.stats()
+            job_stats = get_job_manager().stats()
+            st.sidebar.caption(
+                f"Result cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                f"{cache_stats['entries']} scenes, {cache_stats['bytes'] / 1024 ** 2:.0f} MB. "
+                f"Jobs: {job_stats['running']} running, {job_stats['queued']} queued"
+            )
+
         except Exception as e:
             st.error(f"An error occurred: {str(e)}")
-            # Ensure cleanup happens even if there's an error
-            if os.path.exists(data_folder):
-                for file in glob(os.path.join(data_folder, "*")):
-                    os.remove(file)
-                os.rmdir(data_folder)
     else:
         st.write("Please upload a zip file containing your satellite data.")
 
+    show_instrumentation_panel()
 
 
 if __name__ == "__main__":
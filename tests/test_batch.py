@@ -0,0 +1,33 @@
+import csv
+import io
+
+import batch
+from benchmark import make_synthetic_scene
+
+
+def _journal_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def test_interrupted_batch_resumes_with_the_scenes_not_done(tmp_path):
+    scenes = []
+    for seed in range(2):
+        scenes.append(str(tmp_path / f"scene{seed}.zip"))
+        make_synthetic_scene(scenes[-1], 32, seed=seed)
+    broken = tmp_path / "broken.zip"
+    broken.write_bytes(b"not a zip")
+    output = str(tmp_path / "stats.csv")
+
+    # The first run stops after one scene
+    assert batch.run_batch(scenes[:1], output, workers=1, log=io.StringIO()) == 0
+    log = io.StringIO()
+    assert batch.run_batch(scenes + [str(broken)], output, workers=1, log=log) == 1
+    assert "1 of 3 scenes already done" in log.getvalue()
+    rows = _journal_rows(output)
+    assert [row["scene"] for row in rows] == scenes + [str(broken)]
+    assert [row["status"] for row in rows] == ["ok", "ok", "error"]
+
+    # Failed scenes are retried, finished ones are not
+    assert batch.run_batch(scenes + [str(broken)], output, workers=1, log=io.StringIO()) == 1
+    assert [row["scene"] for row in _journal_rows(output)] == scenes + [str(broken)] * 2
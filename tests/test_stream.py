@@ -0,0 +1,163 @@
+import threading
+
+import numpy as np
+import pytest
+import rasterio.vrt
+
+import stream
+from benchmark import make_synthetic_scene
+
+
+@pytest.fixture(scope="module")
+def scene(tmp_path_factory):
+    path = tmp_path_factory.mktemp("scenes") / "scene.zip"
+    make_synthetic_scene(str(path), 64, nan_fraction=0.01)
+    return str(path)
+
+
+def test_aligned_bands_are_read_without_warping(scene, monkeypatch):
+    warped = []
+
+    class CountingWarpedVRT(rasterio.vrt.WarpedVRT):
+        def __init__(self, *args, **kwargs):
+            warped.append(args)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(rasterio.vrt, "WarpedVRT", CountingWarpedVRT)
+    bands = stream.load_bands_and_compute_indices(scene)
+    quick_look = stream.load_bands_and_compute_indices(scene, decimation=8)
+    assert bands.shape == (64, 64)
+    assert quick_look.shape == (8, 8)
+    assert warped == []
+
+
+def test_only_bands_read_by_indices_are_loaded(scene):
+    assert sorted(stream.load_bands_and_compute_indices(scene)) == stream.compile_index_plan()[2]
+    assert sorted(stream.load_bands_and_compute_indices(scene, names=["NDVI"])) == ["B04", "B08"]
+
+
+@pytest.mark.parametrize("name", stream.INDEX_SHORT_NAMES)
+def test_histogram_percentiles_match_numpy(scene, name):
+    indices = dict(zip(stream.INDEX_SHORT_NAMES, stream.compute_indices(stream.load_bands_and_compute_indices(scene))))
+    values = np.asarray(indices[name])
+    values = values[np.isfinite(values)]
+    stats = stream.reduce_index_statistics(indices)["indices"][name]
+    low, high = stream.INDEX_REGISTRY[name].get("range", (-1, 1))
+    for percent in stream.STATS_PERCENTILES:
+        expected = np.percentile(values, percent)
+        if low <= expected <= high:
+            tolerance = 1e-2 * expected if stream.INDEX_REGISTRY[name].get("scale") == "log" else 3 * (high - low) / 1024
+            assert stats[f"p{percent}"] == pytest.approx(expected, abs=abs(tolerance))
+        else:
+            assert np.isnan(stats[f"p{percent}"])
+
+
+def test_percentiles_beyond_the_index_range_are_nan():
+    accumulator = stream.IndexStatsAccumulator(["NDVI"])
+    accumulator.update({"NDVI": np.array([0.5, 2.0, 3.0, 4.0, 5.0], dtype=np.float32)})
+    stats = accumulator.result()["indices"]["NDVI"]
+    assert stats["p10"] == pytest.approx(0.5, abs=0.01)
+    assert np.isnan(stats["p50"]) and np.isnan(stats["p90"])
+
+
+def test_index_store_keeps_the_field_region(tmp_path):
+    store = stream.IndexStore(str(tmp_path))
+    region = np.zeros((4, 6), dtype=bool)
+    region[1:3, 2:5] = True
+    store.save("field", {"NDVI": np.ones((4, 6), dtype=np.float32)}, region=region)
+    store.save("scene", {"NDVI": np.ones((4, 6), dtype=np.float32)})
+    assert np.array_equal(store.region("field"), region)
+    assert store.region("scene") is None
+
+
+def _original_indices(arr_st):
+    """The formulas compute_indices used before the registry, on a positionally stacked array."""
+    def normalized_diff(b1, b2):
+        return (b1 - b2) / (b1 + b2)
+
+    return {
+        "NDVI": normalized_diff(arr_st[7], arr_st[3]),
+        "SAVI": ((arr_st[7] - arr_st[3]) / (arr_st[7] + arr_st[3] + 0.5)) * 1.5,
+        "VARI": (arr_st[2] - arr_st[3]) / (arr_st[2] + arr_st[3] - arr_st[1]),
+        "MNDWI": normalized_diff(arr_st[1], arr_st[3]),
+        "NDMI": normalized_diff(arr_st[7], arr_st[3]),
+        "CMR": np.divide(arr_st[7], arr_st[5]),
+        "FMR": np.divide(arr_st[7], arr_st[5]),
+        "EVI": 2.5 * (arr_st[7] - arr_st[3]) / (arr_st[7] + 6 * arr_st[3] - 7.5 * arr_st[1] + 1),
+        "NBR": normalized_diff(arr_st[7], arr_st[6]),
+        "GCI": (arr_st[7] / arr_st[1]) - 1,
+        "TCARI": 3 * ((arr_st[3] - arr_st[1]) - 0.2 * (arr_st[3] - arr_st[2]) * (arr_st[3] / arr_st[1])),
+        "BAI": 1 / ((0.1 - arr_st[2]) ** 2 + (0.06 - arr_st[3]) ** 2),
+        "OSAVI": (arr_st[7] - arr_st[3]) / (arr_st[7] + arr_st[3] + 0.16),
+    }
+
+
+def test_registry_matches_the_original_formulas_on_a_stacked_array():
+    rng = np.random.default_rng(3)
+    # Reflectances away from the formulas' poles (e.g. B03 + B04 - B02 near 0)
+    low = np.array([0.01, 0.01, 0.15, 0.1, 0.1, 0.1, 0.1, 0.3])[:, None, None]
+    arr_st = (low + 0.2 * rng.random((8, 32, 48))).astype(np.float32)
+    indices = dict(zip(stream.INDEX_SHORT_NAMES, stream.compute_indices(arr_st)))
+    for name, expected in _original_indices(arr_st).items():
+        np.testing.assert_allclose(indices[name], expected, rtol=1e-5, atol=1e-6, err_msg=name)
+    # The stack has no B11, so the SWIR moisture index is skipped rather than guessed
+    assert indices["NDMI_SWIR"] is None
+
+
+@pytest.mark.parametrize("options", [{}, {"resolution": 20}, {"boundary": (77.001, 10.995, 77.004, 10.999)}])
+def test_windowed_statistics_match_the_full_array_path(scene, options):
+    options = dict(options)
+    if "boundary" in options:
+        options["boundary"] = stream.parse_field_boundary(bbox=options["boundary"])
+    bands = stream.load_bands_and_compute_indices(scene, **options)
+    indices = dict(zip(stream.INDEX_SHORT_NAMES, stream.compute_indices(bands)))
+    full = stream.reduce_index_statistics(indices, region=bands.region)
+    # Blocks of odd row counts, so blocks do not line up with anything
+    windowed = stream.compute_indices_windowed(scene, block_pixels=7 * bands.shape[1], **options)
+
+    assert (windowed["height"], windowed["width"]) == bands.shape
+    assert windowed["valid_fraction"] == full["valid_fraction"]
+    assert windowed["indices"].keys() == {name for name, index in indices.items() if index is not None}
+    for name, stats in windowed["indices"].items():
+        for stat, value in stats.items():
+            assert value == pytest.approx(full["indices"][name][stat], rel=2e-4, abs=1e-6, nan_ok=True), \
+                f"{name} {stat}"
+
+
+def test_result_cache_evicts_least_recently_used_scenes():
+    cache = stream.ResultCache(max_bytes=3 * 400)
+    for key in "abc":
+        assert cache.put(key, {"indices": (np.zeros(100, dtype=np.float32),)})
+    assert cache.get("a") is not None  # "b" is now the least recently used
+    cache.put("d", {"indices": (np.zeros(100, dtype=np.float32),)})
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in "acd")
+    assert cache.stats()["bytes"] == 3 * 400
+
+    # Entries larger than the whole budget are not cached and evict nothing
+    assert not cache.put("huge", np.zeros(1000, dtype=np.float32))
+    assert cache.get("huge") is None
+    assert cache.stats()["entries"] == 3
+
+
+def test_job_manager_admits_jobs_within_the_memory_budget():
+    manager = stream.JobManager(workers=2, memory_budget=100)
+    release = threading.Event()
+    first = manager.submit("first", release.wait, 5, memory=60)
+    second = manager.submit("second", lambda: "done", memory=60)
+    # A free worker is not enough: 60 + 60 bytes do not fit the budget next to each other
+    assert not second.wait(0.2)
+    assert second.status == "queued" and manager.position(second) == 1
+    assert manager.submit("second", lambda: "other") is second  # identical analyses share one job
+
+    release.set()
+    assert first.wait(5) and second.wait(5)
+    assert (first.status, second.status, second.result) == ("done", "done", "done")
+    assert manager.stats()["memory_in_use"] == 0
+
+
+def test_job_manager_rejects_jobs_larger_than_the_budget():
+    manager = stream.JobManager(workers=1, memory_budget=100)
+    job = manager.submit("huge", lambda: "never run", memory=101)
+    assert job.done() and job.status == "rejected" and job.result is None
+    assert job.messages[0][0] == "error" and "coarser resolution" in job.messages[0][1]